@@ -1,46 +1,258 @@
 #!flask/bin/python
 import base64
+import errno
+import hashlib
 import jwt
 import math
 import os
+import Queue
+import re
+import socket
+import sys
+import threading
+import time
+import zlib
 
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from decimal import Decimal
 from dotenv import Dotenv
-from flask import abort, Flask, jsonify, make_response, request, _request_ctx_stack, url_for
+from flask import abort, Blueprint, current_app, Flask, json, jsonify as flask_jsonify, make_response, request, Response, _app_ctx_stack, _request_ctx_stack, url_for
 from functools import wraps
-from sqlalchemy import and_, Column, create_engine, DateTime, desc, ForeignKey, func, Integer, Numeric, Sequence, String
+from sqlalchemy import and_, asc, Boolean, case, Column, create_engine, DateTime, desc, event, exists, Float, ForeignKey, func, Index, inspect, Integer, Interval, literal, Numeric, or_, select, Sequence, String, text, UniqueConstraint
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError, IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import joinedload, relationship, scoped_session, Session as OrmSession, sessionmaker, subqueryload
+from werkzeug.http import unquote_etag
 from werkzeug.local import LocalProxy
 
+# Brotli is optional, responses fall back to gzip without it
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
 # ###############################################
 # ############### Initial config ################
 # ###############################################
 
-# Env configuration
-env = None
-try:
-	env = Dotenv('./.env')
-	# Auth0 data
-	client_id = env['AUTH0_CLIENT_ID']
-	client_secret = env['AUTH0_CLIENT_SECRET']
-	# DB data
-	db_provider = env['DB_PROVIDER']
-	db_user = env['DB_USER']
-	db_password = env['DB_PASSWORD']
-	db_address = env['DB_ADDRESS']
-	db_name = env['DB_NAME']
-except IOError:
-	env = os.environ
-# Flask instance
-app = Flask(__name__)
+def load_config(overrides=None):
+	"""
+	Returns the app configuration read from the .env file
+	and the process environment, which takes precedence,
+	updated with the given overrides.
+	"""
+	env = {}
+	try:
+		env.update(Dotenv('./.env'))
+	except IOError:
+		pass
+	env.update(os.environ)
+	config = {
+		# Auth0 data
+		'AUTH0_CLIENT_ID': env.get('AUTH0_CLIENT_ID', None),
+		'AUTH0_CLIENT_SECRET': env.get('AUTH0_CLIENT_SECRET', None),
+		# DB data, either a full URL or its parts
+		'DB_URL': env.get('DB_URL', None),
+		# DB pool data
+		'DB_POOL_SIZE': int(env.get('DB_POOL_SIZE', 10)),
+		'DB_MAX_OVERFLOW': int(env.get('DB_MAX_OVERFLOW', 20)),
+		'DB_POOL_RECYCLE': int(env.get('DB_POOL_RECYCLE', 1800)),
+		'DB_POOL_TIMEOUT': int(env.get('DB_POOL_TIMEOUT', 10)),
+		# Read replica URLs, comma separated, used by the read-only routes
+		'DB_REPLICA_URLS': [url for url in env.get('DB_REPLICA_URLS', '').split(',') if url],
+		# Replicas lagging further behind are skipped, their lag is checked every few seconds
+		'DB_REPLICA_MAX_LAG': float(env.get('DB_REPLICA_MAX_LAG', 5)),
+		'DB_REPLICA_CHECK_SECONDS': float(env.get('DB_REPLICA_CHECK_SECONDS', 5)),
+		# Users read from the primary for a while after writing
+		'DB_STICKY_SECONDS': float(env.get('DB_STICKY_SECONDS', 10)),
+		# Fail requests exceeding their SQL statement budget (testing)
+		'ASSERT_QUERY_BUDGET': env.get('ASSERT_QUERY_BUDGET', 'false').lower() == 'true',
+		# Report the request timings in a Server-Timing header
+		'SERVER_TIMING': env.get('SERVER_TIMING', 'false').lower() == 'true',
+		# Smaller responses are not worth compressing
+		'COMPRESS_MIN_SIZE': int(env.get('COMPRESS_MIN_SIZE', 1024)),
+		# Token bucket of each user: refill rate (tokens per second, 0 disables it)
+		# and size, every route takes its ROUTE_COSTS tokens
+		'RATE_LIMIT_RATE': float(env.get('RATE_LIMIT_RATE', 5)),
+		'RATE_LIMIT_BURST': float(env.get('RATE_LIMIT_BURST', 20)),
+		# Buckets store shared by the workers, in-process if None
+		'RATE_LIMIT_STORE': None,
+		# Notifications hub shared by the workers, in-process if None
+		'EVENT_BUS': None
+	}
+	# Requests served at once by a process, the rest are shed
+	config['MAX_CONCURRENT_REQUESTS'] = int(env.get('MAX_CONCURRENT_REQUESTS', config['DB_POOL_SIZE'] + config['DB_MAX_OVERFLOW']))
+	if not config['DB_URL'] and 'DB_PROVIDER' in env:
+		config['DB_URL'] = '%s://%s:%s@%s/%s' % (env['DB_PROVIDER'], env['DB_USER'], env['DB_PASSWORD'], env['DB_ADDRESS'], env['DB_NAME'])
+	config.update(overrides or {})
+	return config
+
+def decode_secret(secret):
+	"""
+	Returns the Auth0 signing key of the given client
+	secret.
+	"""
+	return base64.b64decode(secret.replace('_','/').replace('-','+'))
+
+def make_engine(config):
+	"""
+	Returns a new engine for the configured database.
+	"""
+	url = make_url(config['DB_URL'])
+	pool_options = {}
+	if url.get_backend_name() != 'sqlite':
+		pool_options = {
+			'pool_size': config['DB_POOL_SIZE'],
+			'max_overflow': config['DB_MAX_OVERFLOW'],
+			'pool_recycle': config['DB_POOL_RECYCLE'],
+			'pool_timeout': config['DB_POOL_TIMEOUT']
+		}
+	engine = create_engine(url, echo=False, **pool_options)
+	if url.get_backend_name() == 'sqlite':
+		# SQLite lacks the math functions used by the nearme query
+		@event.listens_for(engine, 'connect')
+		def sqlite_functions(connection, record):
+			connection.create_function('acos', 1, lambda x: math.acos(max(-1.0, min(1.0, x))))
+			connection.create_function('cos', 1, math.cos)
+			connection.create_function('sin', 1, math.sin)
+			connection.create_function('radians', 1, math.radians)
+			connection.create_function('floor', 1, lambda x: int(math.floor(x)))
+	return engine
+
+# Seconds behind the primary, zero when the replica has replayed everything it received
+REPLICA_LAG_SQL = {
+	'postgresql': (
+		'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+		'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'
+	)
+}
+
+def measure_lag(engine):
+	"""
+	Returns how many seconds the given replica lags behind
+	its primary, None if it can not be reached. Databases
+	without a lag query are taken as up to date.
+	"""
+	sql = REPLICA_LAG_SQL.get(engine.dialect.name)
+	if sql is None:
+		return 0.0
+	try:
+		with engine.connect() as connection:
+			return float(connection.execute(text(sql)).scalar() or 0)
+	except DBAPIError:
+		return None
+
+class Database(object):
+	"""
+	Creates the primary and replica engines on first use
+	from the configuration given by the app (or the
+	environment) and disposes their pools in forked
+	processes, so workers never share the connections
+	opened by their parent.
+	"""
+	def __init__(self):
+		self.config = None
+		self.engine = None
+		self.replicas = []
+		self.lags = {}
+		self.turn = 0
+		self.pid = None
+		self.lock = threading.Lock()
+
+	def configure(self, config):
+		with self.lock:
+			self.dispose()
+			self.config = config
+			self.engine = None
+			self.replicas = []
+			self.lags = {}
+
+	def dispose(self):
+		for engine in [self.engine] + self.replicas:
+			if engine is not None:
+				engine.dispose()
+
+	def engines(self):
+		# Called with the lock held
+		if self.engine is None:
+			self.config = self.config or load_config()
+			self.engine = make_engine(self.config)
+			self.replicas = [make_engine(dict(self.config, DB_URL=url)) for url in self.config['DB_REPLICA_URLS']]
+			self.pid = os.getpid()
+		elif self.pid != os.getpid():
+			self.dispose()
+			self.pid = os.getpid()
+		return self.engine, self.replicas
+
+	def get_engine(self):
+		with self.lock:
+			return self.engines()[0]
+
+	def get_replica(self):
+		"""
+		Returns the next replica in turn lagging at most
+		DB_REPLICA_MAX_LAG seconds, or the primary engine
+		if there is none.
+		"""
+		with self.lock:
+			engine, replicas = self.engines()
+			self.turn += 1
+			turn = self.turn
+		for i in range(len(replicas)):
+			replica = replicas[(turn + i) % len(replicas)]
+			lag = self.replica_lag(replica)
+			if lag is not None and lag <= self.config['DB_REPLICA_MAX_LAG']:
+				return replica
+		return engine
+
+	def replica_lag(self, replica):
+		"""
+		Returns the lag of the given replica, measured at most
+		every DB_REPLICA_CHECK_SECONDS.
+		"""
+		checked_at, lag = self.lags.get(replica, (0, None))
+		if time.time() - checked_at >= self.config['DB_REPLICA_CHECK_SECONDS']:
+			lag = measure_lag(replica)
+			self.lags[replica] = (time.time(), lag)
+		return lag
+
+	def replica_lags(self):
+		"""
+		Returns the last measured lag of every replica.
+		"""
+		with self.lock:
+			replicas = list(self.replicas)
+		return [self.lags.get(replica, (0, None))[1] for replica in replicas]
+
+class RoutingSession(OrmSession):
+	"""
+	Sends the statements of read-only requests to a replica,
+	the same one for the whole session, and everything else
+	to the primary.
+	"""
+	def get_bind(self, mapper=None, clause=None):
+		if self._flushing or not reads_from_replica():
+			return db.get_engine()
+		if 'replica' not in self.info:
+			self.info['replica'] = db.get_replica()
+		return self.info['replica']
+
+# API routes, registered by create_app
+api = Blueprint('api', __name__)
 # Authentication annotation
 current_user = LocalProxy(lambda: _request_ctx_stack.top.current_user)
-# Database initialization
-engine = create_engine('%s://%s:%s@%s/%s' % (db_provider, db_user, db_password, db_address, db_name), echo=False)
+# Database initialization, deferred until first use
+db = Database()
+get_engine = db.get_engine
+engine = LocalProxy(get_engine)
 Base = declarative_base()
-Session = sessionmaker(bind=engine, autocommit=False)
-session = Session()
+Session = sessionmaker(class_=RoutingSession, autocommit=False)
+# One session per application context (request)
+session = scoped_session(Session, scopefunc=_app_ctx_stack.__ident_func__)
 
 # ###############################################
 # ################## Constants ##################
@@ -62,8 +274,118 @@ OFFER_ORDER_LIMIT = 7
 
 DEFAULT_ORDER_RADIUS = 1
 
+BATCH_ORDER_LIMIT = 50
+BATCH_OPEN_ORDER_LIMIT = 500
+
+ARCHIVE_AFTER_DAYS = 90
+ARCHIVE_BATCH_SIZE = 1000
+
+DEFAULT_PAGE_LIMIT = 20
+MAX_PAGE_LIMIT = 100
+
+CURSOR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+TOKEN_CACHE_SIZE = 4096
+RATE_BUCKETS_SIZE = 4096
+RECENT_WRITERS_SIZE = 4096
+
+STORE_CHANNEL = 'store:%d'
+ORDER_CHANNEL = 'order:%d'
+EVENT_QUEUE_SIZE = 100
+EVENT_MESSAGE_SIZE = 1 << 18
+STREAM_HEARTBEAT_SECONDS = 15
+MAX_WAIT_SECONDS = 30
+
+# Rate limit tokens taken by the heavier routes, 1 by the rest
+ROUTE_COSTS = {
+	'get_finished_orders': 2,
+	'get_order_stores': 2,
+	'get_nearme_orders': 5,
+	'stream_nearme_orders': 5,
+	'create_orders': 5
+}
+
+REQUEST_TIMINGS = ('db', 'auth', 'serialize')
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/plain', 'text/html')
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
 KM_UNIT = 6371
 
+GRID_CELL_DEGREES = 0.01
+COVERAGE_CELL_DEGREES = 0.05
+
+# ###############################################
+# ################ Geo functions ################
+# ###############################################
+
+def grid_cell(lat, lon, size=GRID_CELL_DEGREES):
+	"""
+	Returns the (lat_cell, lon_cell) pair of the grid
+	cell of the given size that contains the given
+	coordinates.
+	"""
+	return (
+		int(math.floor(float(lat) / size)),
+		int(math.floor(float(lon) / size))
+	)
+
+def covering_cells(lat, lon, radius, size=GRID_CELL_DEGREES):
+	"""
+	Returns the grid cells of the given size covering the
+	circle of the given radius (in km) around the given
+	coordinates, as a tuple
+	(min_lat_cell, max_lat_cell, lon_cell_ranges). There is
+	more than one longitude range when the circle crosses
+	the antimeridian.
+	"""
+	lat = float(lat)
+	lon = float(lon)
+	delta = math.degrees(float(radius) / KM_UNIT)
+	min_lat = max(lat - delta, -90.0)
+	max_lat = min(lat + delta, 90.0)
+	# Longitude degrees shrink towards the poles, so use
+	# the box edge closest to one of them
+	cos_lat = min(math.cos(math.radians(min_lat)), math.cos(math.radians(max_lat)))
+	lon_ranges = [(-180.0, 180.0)]
+	if cos_lat > 0 and delta / cos_lat < 180:
+		lon_delta = delta / cos_lat
+		min_lon = lon - lon_delta
+		max_lon = lon + lon_delta
+		if min_lon < -180:
+			lon_ranges = [(-180.0, max_lon), (min_lon + 360, 180.0)]
+		elif max_lon > 180:
+			lon_ranges = [(min_lon, 180.0), (-180.0, max_lon - 360)]
+		else:
+			lon_ranges = [(min_lon, max_lon)]
+	min_lat_cell, _ = grid_cell(min_lat, 0, size)
+	max_lat_cell, _ = grid_cell(max_lat, 0, size)
+	lon_cell_ranges = [(grid_cell(0, low, size)[1], grid_cell(0, high, size)[1]) for low, high in lon_ranges]
+	return min_lat_cell, max_lat_cell, lon_cell_ranges
+
+def distance(lat1, lon1, lat2, lon2):
+	"""
+	Returns the great-circle distance (in km) between the
+	given coordinates, same as the nearme query does.
+	"""
+	lat1, lon1, lat2, lon2 = map(math.radians, map(float, (lat1, lon1, lat2, lon2)))
+	angle = math.cos(lat1) * math.cos(lat2) * math.cos(lon2 - lon1) + math.sin(lat1) * math.sin(lat2)
+	return KM_UNIT * math.acos(max(-1.0, min(1.0, angle)))
+
+def cells_filter(model, lat, lon, radius):
+	"""
+	Returns a filter clause matching the rows of the given
+	model whose grid cell lies inside the cells covering
+	the given circle, suitable for an index range scan.
+	"""
+	min_lat_cell, max_lat_cell, lon_cell_ranges = covering_cells(lat, lon, radius)
+	return and_(
+		model.lat_cell.between(min_lat_cell, max_lat_cell),
+		or_(*[model.lon_cell.between(low, high) for low, high in lon_cell_ranges])
+	)
+
 # ###############################################
 # ################## DB Models ##################
 # ###############################################
@@ -76,7 +398,7 @@ class Item(Base):
 	amount = Column(Integer)
 	name = Column(String(100))
 	# Table relations
-	order_id = Column(Integer, ForeignKey('orders.id'))
+	order_id = Column(Integer, ForeignKey('orders.id'), index=True)
 	# Table linking
 	order = relationship('Order', back_populates='items')
 	# Serialization
@@ -93,25 +415,18 @@ class Offer(Base):
 	__tablename__ = 'offers'
 	# Table attributes
 	id = Column(Integer, Sequence('offer_id_seq'), primary_key=True)
-	price = Column(String(25))
-	time = Column(String(25))
+	price = Column(Numeric(12, 2))
+	time = Column(Interval)
 	# Table relations
-	order_id = Column(Integer, ForeignKey('orders.id'))
-	store_id = Column(Integer, ForeignKey('stores.id'))
+	order_id = Column(Integer, ForeignKey('orders.id'), index=True)
+	store_id = Column(Integer, ForeignKey('stores.id'), index=True)
+	# Table indexes, one offer per store and order
+	__table_args__ = (
+		UniqueConstraint('order_id', 'store_id', name='uq_offers_order_store'),
+	)
 	# Table linking
 	order = relationship('Order', back_populates='offers')
 	store = relationship('Store', back_populates='offers')
-	# Serialization
-	@property
-	def serialize(self):
-		return {
-			'id': self.id,
-			'price': self.price,
-			'time': self.time,
-			'order_id': self.order_id,
-			'store_id': self.store_id,
-			'stars': self.store.stars
-		}
 
 class Order(Base):
 	# Table name
@@ -124,10 +439,26 @@ class Order(Base):
 	time = Column(String(25))
 	lat = Column(Numeric)
 	lon = Column(Numeric)
+	lat_cell = Column(Integer)
+	lon_cell = Column(Integer)
 	user_id = Column(String(50))
 	created_at = Column(DateTime)
+	# Bumped on every change clients may be polling for
+	revision = Column(Integer, nullable=False, default=0, server_default='0')
+	offer_count = Column(Integer, nullable=False, default=0, server_default='0')
+	# Made through the batch endpoint, exempt from the one made order rule
+	batch = Column(Boolean, nullable=False, default=False, server_default='0')
 	# Table relations
 	store_id = Column(Integer, ForeignKey('stores.id'))
+	# Table indexes
+	__table_args__ = (
+		Index('ix_orders_status_cell', 'status', 'lat_cell', 'lon_cell'),
+		Index('ix_orders_user_status_created', 'user_id', 'status', 'created_at', 'id'),
+		Index('ix_orders_store_status_created', 'store_id', 'status', 'created_at', 'id'),
+		# A user can only have one made order at a time, besides the batch ones
+		Index('uq_orders_user_made', 'user_id', unique=True,
+			postgresql_where=and_(status == ORDER_MADE, batch == False), sqlite_where=and_(status == ORDER_MADE, batch == False)),
+	)
 	# Table linking
 	store = relationship('Store', back_populates='orders')
 	items = relationship('Item', back_populates='order')
@@ -161,7 +492,7 @@ class Rating(Base):
 	stars = Column(Integer)
 	comment = Column(String(200))
 	# Table relations
-	order_id = Column(Integer, ForeignKey('orders.id'))
+	order_id = Column(Integer, ForeignKey('orders.id'), index=True)
 	# Table linking
 	order = relationship('Order', back_populates='rating')
 	# Serialization
@@ -180,7 +511,9 @@ class Store(Base):
 	id = Column(Integer, Sequence('store_id_seq'), primary_key=True)
 	name = Column(String(100))
 	place = Column(String(100))
-	stars = Column(Integer)
+	stars = Column(Float)
+	rating_count = Column(Integer, nullable=False, default=0, server_default='0')
+	rating_sum = Column(Integer, nullable=False, default=0, server_default='0')
 	lat = Column(Numeric)
 	lon = Column(Numeric)
 	rad = Column(Integer)
@@ -192,66 +525,374 @@ class Store(Base):
 	# Serialization
 	@property
 	def serialize(self):
-		return {
-    		'id': self.id,
-    		'name': self.name,
-    		'place': self.place,
-    		'stars': self.stars,
-    		'geoplace': {
-    			'lat': float(self.lat),
-    			'lon': float(self.lon)
-    		},
-    		'created_at': self.created_at,
-    		'user_id': self.user_id
-    	}
+		return serialize_fields(self, STORE_FIELDS, STORE_FIELDS)
+
+class StoreCell(Base):
+	# Table name
+	__tablename__ = 'store_cells'
+	# Table attributes
+	lat_cell = Column(Integer, primary_key=True, autoincrement=False)
+	lon_cell = Column(Integer, primary_key=True, autoincrement=False)
+	# Table relations
+	store_id = Column(Integer, ForeignKey('stores.id', ondelete='CASCADE'), primary_key=True, autoincrement=False, index=True)
+
+def store_cells(store_id, lat, lon, rad):
+	"""
+	Returns the rows of the coverage cells of the store
+	with the given location and radius.
+	"""
+	min_lat_cell, max_lat_cell, lon_cell_ranges = covering_cells(lat, lon, rad or DEFAULT_ORDER_RADIUS, COVERAGE_CELL_DEGREES)
+	return [{
+		'lat_cell': lat_cell,
+		'lon_cell': lon_cell,
+		'store_id': store_id
+	} for lat_cell in range(min_lat_cell, max_lat_cell + 1) for low, high in lon_cell_ranges for lon_cell in range(low, high + 1)]
+
+@event.listens_for(Store, 'after_insert')
+@event.listens_for(Store, 'after_update')
+def update_store_cells(mapper, connection, store):
+	"""
+	Rebuilds the coverage cells of a store when it is
+	created, moved or its radius changes.
+	"""
+	state = inspect(store)
+	if not any(state.attrs[name].history.has_changes() for name in ('lat', 'lon', 'rad')):
+		return
+	connection.execute(StoreCell.__table__.delete().where(StoreCell.store_id == store.id))
+	connection.execute(StoreCell.__table__.insert(), store_cells(store.id, store.lat, store.lon, store.rad))
+
+@event.listens_for(Store, 'before_delete')
+def delete_store_cells(mapper, connection, store):
+	"""
+	Removes the coverage cells of a store before it is
+	deleted, databases ignoring the cascade keep none.
+	"""
+	connection.execute(StoreCell.__table__.delete().where(StoreCell.store_id == store.id))
+
+class ArchivedOrder(Base):
+	# Table name
+	__tablename__ = 'archived_orders'
+	# Table attributes
+	id = Column(Integer, primary_key=True, autoincrement=False)
+	place = Column(String(100))
+	status = Column(Integer)
+	price = Column(String(25))
+	time = Column(String(25))
+	lat = Column(Numeric)
+	lon = Column(Numeric)
+	user_id = Column(String(50))
+	revision = Column(Integer, nullable=False, default=0, server_default='0')
+	created_at = Column(DateTime)
+	# Table relations
+	store_id = Column(Integer, ForeignKey('stores.id'))
+	# Table indexes, the finished orders listings of users and stores
+	__table_args__ = (
+		Index('ix_archived_orders_user_created', 'user_id', 'created_at', 'id'),
+		Index('ix_archived_orders_store_created', 'store_id', 'created_at', 'id'),
+	)
+
+class ArchivedItem(Base):
+	# Table name
+	__tablename__ = 'archived_items'
+	# Table attributes
+	id = Column(Integer, primary_key=True, autoincrement=False)
+	amount = Column(Integer)
+	name = Column(String(100))
+	# Table relations
+	order_id = Column(Integer, ForeignKey('archived_orders.id'), index=True)
+
+class ArchivedRating(Base):
+	# Table name
+	__tablename__ = 'archived_ratings'
+	# Table attributes
+	id = Column(Integer, primary_key=True, autoincrement=False)
+	stars = Column(Integer)
+	comment = Column(String(200))
+	# Table relations
+	order_id = Column(Integer, ForeignKey('archived_orders.id'), index=True)
+
+# Order tables in use and their archive, as (orders, items, ratings)
+HOT_TABLES = (Order, Item, Rating)
+ARCHIVE_TABLES = (ArchivedOrder, ArchivedItem, ArchivedRating)
+
+# Tables are managed by the Alembic migrations (see migrations/)
+
+# ###############################################
+# ############### Instrumentation ###############
+# ###############################################
+
+def prometheus_metric(name, kind, description, samples):
+	"""
+	Returns the Prometheus text lines of a metric given
+	its (suffix, labels, value) samples.
+	"""
+	lines = ['# HELP %s %s' % (name, description), '# TYPE %s %s' % (name, kind)]
+	for suffix, labels, value in samples:
+		label = ','.join('%s="%s"' % (key, labels[key]) for key in sorted(labels))
+		lines.append('%s%s%s %s' % (name, suffix, '{%s}' % label if label else '', repr(value)))
+	return lines
+
+class Metrics(object):
+	"""
+	Per route request latency histograms, status counts
+	and SQL, authentication and serialization totals.
+	"""
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.routes = {}
+		self.lock = threading.Lock()
+
+	def observe(self, route, status, seconds, timings, statements):
+		with self.lock:
+			metrics = self.routes.get(route)
+			if metrics is None:
+				metrics = self.routes[route] = {
+					'buckets': [0] * len(self.buckets),
+					'count': 0,
+					'sum': 0.0,
+					'statuses': {},
+					'statements': 0,
+					'timings': dict.fromkeys(REQUEST_TIMINGS, 0.0)
+				}
+			for i, bound in enumerate(self.buckets):
+				if seconds <= bound:
+					metrics['buckets'][i] += 1
+			metrics['count'] += 1
+			metrics['sum'] += seconds
+			metrics['statuses'][status] = metrics['statuses'].get(status, 0) + 1
+			metrics['statements'] += statements
+			for name in REQUEST_TIMINGS:
+				metrics['timings'][name] += timings[name]
+
+	def render(self):
+		with self.lock:
+			routes = sorted(self.routes.items())
+			latency = []
+			for route, metrics in routes:
+				for bound, count in zip(self.buckets, metrics['buckets']):
+					latency.append(('_bucket', { 'route': route, 'le': repr(float(bound)) }, count))
+				latency.append(('_bucket', { 'route': route, 'le': '+Inf' }, metrics['count']))
+				latency.append(('_sum', { 'route': route }, metrics['sum']))
+				latency.append(('_count', { 'route': route }, metrics['count']))
+			lines = prometheus_metric('move_request_duration_seconds', 'histogram', 'Request latency by route.', latency)
+			lines += prometheus_metric('move_requests_total', 'counter', 'Requests by route and status.',
+				[('', { 'route': route, 'status': status }, count) for route, metrics in routes for status, count in sorted(metrics['statuses'].items())])
+			lines += prometheus_metric('move_sql_statements_total', 'counter', 'SQL statements run by route.',
+				[('', { 'route': route }, metrics['statements']) for route, metrics in routes])
+			for name in REQUEST_TIMINGS:
+				lines += prometheus_metric('move_%s_duration_seconds_total' % name, 'counter', 'Time spent on %s by route.' % name,
+					[('', { 'route': route }, metrics['timings'][name]) for route, metrics in routes])
+			return lines
+
+# Request metrics
+metrics = Metrics(LATENCY_BUCKETS)
+
+def record_timing(name, seconds):
+	"""
+	Adds the given seconds to the named timing of the
+	current request, if any.
+	"""
+	ctx = _request_ctx_stack.top
+	if ctx is not None and hasattr(ctx, 'timings'):
+		ctx.timings[name] += seconds
+
+def jsonify(*args, **kwargs):
+	"""
+	Same as Flask's jsonify, timing the encoding as the
+	request serialization.
+	"""
+	started = time.time()
+	response = flask_jsonify(*args, **kwargs)
+	record_timing('serialize', time.time() - started)
+	return response
+
+@api.before_app_request
+def start_request():
+	ctx = _request_ctx_stack.top
+	ctx.started = time.time()
+	ctx.timings = dict.fromkeys(REQUEST_TIMINGS, 0.0)
+
+@api.after_app_request
+def finish_request(response):
+	ctx = _request_ctx_stack.top
+	if not hasattr(ctx, 'started'):
+		return response
+	seconds = time.time() - ctx.started
+	metrics.observe(request.endpoint or 'unmatched', response.status_code, seconds, ctx.timings, getattr(ctx, 'sql_statements', 0))
+	if current_app.config['SERVER_TIMING']:
+		timings = [(name, ctx.timings[name]) for name in REQUEST_TIMINGS] + [('total', seconds)]
+		response.headers['Server-Timing'] = ', '.join('%s;dur=%.2f' % (name, value * 1000) for name, value in timings)
+	return response
 
-# Create tables
-Base.metadata.create_all(engine)
-session.commit()
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+	ctx = _request_ctx_stack.top
+	if ctx is not None:
+		ctx.sql_statements = getattr(ctx, 'sql_statements', 0) + 1
+		context.statement_started = time.time()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def finish_statement(conn, cursor, statement, parameters, context, executemany):
+	started = getattr(context, 'statement_started', None)
+	if started is not None:
+		record_timing('db', time.time() - started)
+
+def query_budget(limit):
+	"""
+	Declares the maximum number of SQL statements a
+	route may run regardless of the result size, it is
+	enforced when ASSERT_QUERY_BUDGET is enabled.
+	"""
+	def decorator(f):
+		@wraps(f)
+		def decorated(*args, **kwargs):
+			ctx = _request_ctx_stack.top
+			start = getattr(ctx, 'sql_statements', 0)
+			response = f(*args, **kwargs)
+			count = getattr(ctx, 'sql_statements', 0) - start
+			if current_app.config['ASSERT_QUERY_BUDGET'] and count > limit:
+				raise AssertionError('%s ran %d SQL statements, budget is %d' % (f.__name__, count, limit))
+			return response
+		return decorated
+	return decorator
+
+# ###############################################
+# ################# Compression #################
+# ###############################################
+
+def content_encodings():
+	"""
+	Returns the supported response encodings, the
+	preferred first.
+	"""
+	return ['br', 'gzip'] if brotli else ['gzip']
+
+def compress(data, encoding):
+	"""
+	Returns the given data compressed with the given
+	encoding.
+	"""
+	if encoding == 'br':
+		return brotli.compress(data, quality=BROTLI_QUALITY)
+	compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	return compressor.compress(data) + compressor.flush()
+
+@api.after_app_request
+def compress_response(response):
+	if response.status_code != 200 or response.direct_passthrough or response.is_streamed:
+		return response
+	if response.mimetype not in COMPRESSIBLE_MIMETYPES or 'Content-Encoding' in response.headers:
+		return response
+	response.vary.add('Accept-Encoding')
+	encoding = request.accept_encodings.best_match(content_encodings())
+	if encoding is None or response.content_length < current_app.config['COMPRESS_MIN_SIZE']:
+		return response
+	response.set_data(compress(response.get_data(), encoding))
+	response.headers['Content-Encoding'] = encoding
+	# The compressed bytes differ, but they stand for the same representation
+	etag, weak = response.get_etag()
+	if etag:
+		response.set_etag(etag, weak=True)
+	return response
 
 # ###############################################
 # ############### Error handling ################
 # ###############################################
 
-@app.errorhandler(400)
+@api.app_errorhandler(400)
 def bad_request(error):
 	session.rollback()
 	return make_response(jsonify({ 'error': 'bad request' }), 400)
 
-@app.errorhandler(401)
+@api.app_errorhandler(401)
 def unauthorized(error):
 	session.rollback()
 	return make_response(jsonify({ 'error': 'unauthorized' }), 401)
 
-@app.errorhandler(404)
+@api.app_errorhandler(404)
 def not_found(error):
 	session.rollback()
 	return make_response(jsonify({ 'error': 'not found' }), 404)
 
-@app.errorhandler(405)
+@api.app_errorhandler(405)
 def bad_method(error):
 	session.rollback()
 	return make_response(jsonify({ 'error': 'method not allowed' }), 405)
 
-@app.errorhandler(409)
+@api.app_errorhandler(409)
 def conflict(error):
 	session.rollback()
 	return make_response(jsonify({ 'error': 'conflict resource' }), 409)
 
-@app.errorhandler(500)
+@api.app_errorhandler(429)
+def too_many_requests(error):
+	session.rollback()
+	return retry_later(make_response(jsonify({ 'error': 'too many requests, slow down' }), 429))
+
+@api.app_errorhandler(500)
 def unknown(error):
 	session.rollback()
 	return make_response(jsonify({ 'error': 'unknown error, try again later' }), 500)
 
-@app.teardown_request
+@api.app_errorhandler(503)
+def unavailable(error):
+	session.rollback()
+	return retry_later(make_response(jsonify({ 'error': 'service busy, try again later' }), 503))
+
+def retry_later(response):
+	retry_after = getattr(_request_ctx_stack.top, 'retry_after', 1)
+	response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+	return response
+
+@api.teardown_app_request
 def teardown_request(exception):
 	if exception:
 		session.rollback()
 
+def teardown_appcontext(exception):
+	session.remove()
+
 # ###############################################
 # ################ Authorization ################
 # ###############################################
 
+class TokenCache(object):
+	"""
+	Bounded LRU of verified token payloads keyed by the
+	token hash, entries are dropped once they expire.
+	"""
+	def __init__(self, size):
+		self.size = size
+		self.hits = 0
+		self.misses = 0
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+
+	def key(self, token):
+		return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+	def get(self, token):
+		key = self.key(token)
+		with self.lock:
+			payload = self.entries.pop(key, None)
+			if payload is not None and payload.get('exp', float('inf')) > time.time():
+				self.entries[key] = payload
+				self.hits += 1
+				return payload
+			self.misses += 1
+			return None
+
+	def set(self, token, payload):
+		key = self.key(token)
+		with self.lock:
+			self.entries.pop(key, None)
+			self.entries[key] = payload
+			while len(self.entries) > self.size:
+				self.entries.popitem(last=False)
+
+# Verified tokens
+token_cache = TokenCache(TOKEN_CACHE_SIZE)
+
 def requires_auth(f):
 	@wraps(f)
 	def decorated(*args, **kwargs):
@@ -268,25 +909,682 @@ def requires_auth(f):
 			abort(400)
 
 		token = parts[1]
-		try:
-			payload = jwt.decode(
-				token,
-				base64.b64decode(client_secret.replace('_','/').replace('-','+')),
-				audience=client_id
-			)
-		except Exception:
-			abort(401)
+		started = time.time()
+		payload = token_cache.get(token)
+		if payload is None:
+			try:
+				payload = jwt.decode(
+					token,
+					current_app.config['AUTH0_SECRET'],
+					audience=current_app.config['AUTH0_CLIENT_ID']
+				)
+			except Exception:
+				abort(401)
+			token_cache.set(token, payload)
+		record_timing('auth', time.time() - started)
 
 		_request_ctx_stack.top.current_user = user = payload
+		admit(user['sub'])
+		try:
+			return f(*args, **kwargs)
+		finally:
+			active_requests.leave()
+	return decorated
+
+# ###############################################
+# ############## Admission control ##############
+# ###############################################
+
+class MemoryBuckets(object):
+	"""
+	Bounded LRU of the token buckets of the users, kept
+	in-process. Any object with the same take method,
+	e.g. one backed by a store shared by every worker,
+	can replace it through the RATE_LIMIT_STORE setting.
+	"""
+	def __init__(self, size):
+		self.size = size
+		self.buckets = OrderedDict()
+		self.lock = threading.Lock()
+
+	def take(self, key, cost, rate, burst):
+		"""
+		Takes cost tokens from the bucket of the given key,
+		refilled at rate tokens per second up to burst, and
+		returns 0, or the seconds until there are enough
+		tokens if there are not.
+		"""
+		now = time.time()
+		with self.lock:
+			tokens, updated = self.buckets.pop(key, (burst, now))
+			tokens = min(burst, tokens + (now - updated) * rate)
+			wait = 0.0
+			if tokens >= cost:
+				tokens -= cost
+			else:
+				wait = (cost - tokens) / rate
+			self.buckets[key] = (tokens, now)
+			while len(self.buckets) > self.size:
+				self.buckets.popitem(last=False)
+		return wait
+
+class ActiveRequests(object):
+	"""
+	Counts the requests being served by this process.
+	"""
+	def __init__(self):
+		self.count = 0
+		self.lock = threading.Lock()
+
+	def enter(self, limit=None):
+		with self.lock:
+			if limit is not None and self.count >= limit:
+				return False
+			self.count += 1
+			return True
+
+	def leave(self):
+		with self.lock:
+			self.count -= 1
+
+# Token buckets of the users, unless a shared store is configured
+rate_buckets = MemoryBuckets(RATE_BUCKETS_SIZE)
+active_requests = ActiveRequests()
+
+def pool_saturated():
+	"""
+	Returns whether every connection the primary database
+	pool may open is checked out.
+	"""
+	pool = db.get_engine().pool
+	if not isinstance(pool, QueuePool):
+		return False
+	return pool.checkedout() >= current_app.config['DB_POOL_SIZE'] + current_app.config['DB_MAX_OVERFLOW']
+
+def admit(user_id):
+	"""
+	Admits the current request of the given user, aborts
+	it with 429 if the user's bucket lacks the route cost,
+	or with 503 if the process serves as many requests as
+	it may or the database pool is exhausted. Admitted
+	requests must leave active_requests once served.
+	"""
+	config = current_app.config
+	ctx = _request_ctx_stack.top
+	if config['RATE_LIMIT_RATE'] > 0:
+		cost = min(ROUTE_COSTS.get(request.endpoint.split('.')[-1], 1), config['RATE_LIMIT_BURST'])
+		buckets = config['RATE_LIMIT_STORE'] or rate_buckets
+		wait = buckets.take(user_id, cost, config['RATE_LIMIT_RATE'], config['RATE_LIMIT_BURST'])
+		if wait > 0:
+			ctx.retry_after = wait
+			abort(429)
+	if pool_saturated() or not active_requests.enter(config['MAX_CONCURRENT_REQUESTS']):
+		abort(503)
+
+# ###############################################
+# ############### Replica routing ###############
+# ###############################################
+
+class RecentWriters(object):
+	"""
+	Bounded LRU of the time each user last wrote, so
+	their reads can go to the primary until the replicas
+	catch up with their own writes.
+	"""
+	def __init__(self, size):
+		self.size = size
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+
+	def add(self, user_id):
+		with self.lock:
+			self.entries.pop(user_id, None)
+			self.entries[user_id] = time.time()
+			while len(self.entries) > self.size:
+				self.entries.popitem(last=False)
+
+	def wrote_within(self, user_id, seconds):
+		with self.lock:
+			written = self.entries.get(user_id, None)
+		return written is not None and time.time() - written < seconds
+
+# Users who wrote lately
+recent_writers = RecentWriters(RECENT_WRITERS_SIZE)
+
+def read_only(f):
+	"""
+	Marks a route that never writes, so its statements
+	may be served by a replica.
+	"""
+	@wraps(f)
+	def decorated(*args, **kwargs):
+		_request_ctx_stack.top.read_only = True
 		return f(*args, **kwargs)
 	return decorated
 
+def reads_from_replica():
+	"""
+	Returns whether the current request is read-only and
+	its user has not written within DB_STICKY_SECONDS.
+	"""
+	ctx = _request_ctx_stack.top
+	if ctx is None or not getattr(ctx, 'read_only', False):
+		return False
+	user = getattr(ctx, 'current_user', None)
+	return user is None or not recent_writers.wrote_within(user['sub'], current_app.config['DB_STICKY_SECONDS'])
+
+@api.after_app_request
+def remember_writer(response):
+	user = getattr(_request_ctx_stack.top, 'current_user', None)
+	if user is not None and request.method not in ('GET', 'HEAD') and response.status_code < 400:
+		recent_writers.add(user['sub'])
+	return response
+
+# ###############################################
+# ################ Notifications ################
+# ###############################################
+
+class EventBus(object):
+	"""
+	In-process publish/subscribe hub, every subscriber
+	gets a bounded queue of the messages published on
+	its channel, dropping them when it falls behind.
+	Any object with the same subscribe, unsubscribe and
+	publish methods, e.g. one shared by every worker, can
+	replace it through the EVENT_BUS setting.
+	"""
+	def __init__(self):
+		self.channels = {}
+		self.lock = threading.Lock()
+
+	def subscribe(self, channel):
+		queue = Queue.Queue(EVENT_QUEUE_SIZE)
+		with self.lock:
+			self.channels.setdefault(channel, set()).add(queue)
+		return queue
+
+	def unsubscribe(self, channel, queue):
+		with self.lock:
+			queues = self.channels.get(channel, set())
+			queues.discard(queue)
+			if not queues:
+				self.channels.pop(channel, None)
+
+	def publish(self, channel, message):
+		with self.lock:
+			queues = list(self.channels.get(channel, ()))
+		for queue in queues:
+			try:
+				queue.put_nowait(message)
+			except Queue.Full:
+				pass
+
+class SocketEventBus(EventBus):
+	"""
+	Publish/subscribe hub shared by the processes of a
+	host. Each process binds a datagram socket in the
+	given directory on first use and hands the messages
+	it receives to its own subscribers, publishing sends
+	a message to every socket in the directory. Messages
+	a process can not take in time are dropped.
+	"""
+	def __init__(self, path):
+		EventBus.__init__(self)
+		self.path = path
+		self.pid = None
+		self.sender = None
+		self.listen_lock = threading.Lock()
+
+	def listen(self):
+		"""
+		Binds the socket of this process and starts handing
+		its messages over, once per process so forked workers
+		never share it.
+		"""
+		with self.listen_lock:
+			if self.pid == os.getpid():
+				return
+			if not os.path.isdir(self.path):
+				os.makedirs(self.path)
+			name = os.path.join(self.path, '%d.sock' % os.getpid())
+			if os.path.exists(name):
+				os.unlink(name)
+			receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+			receiver.bind(name)
+			self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+			self.sender.setblocking(False)
+			self.pid = os.getpid()
+			thread = threading.Thread(target=self.receive, args=(receiver,))
+			thread.daemon = True
+			thread.start()
+
+	def receive(self, receiver):
+		while True:
+			try:
+				channel, message = json.loads(receiver.recv(EVENT_MESSAGE_SIZE))
+			except ValueError:
+				continue
+			EventBus.publish(self, channel, message)
+
+	def subscribe(self, channel):
+		self.listen()
+		return EventBus.subscribe(self, channel)
+
+	def publish(self, channel, message):
+		self.listen()
+		data = json.dumps([channel, message])
+		for name in os.listdir(self.path):
+			if not name.endswith('.sock'):
+				continue
+			try:
+				self.sender.sendto(data, os.path.join(self.path, name))
+			except socket.error as e:
+				if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+					# Left behind by a process that is gone
+					try:
+						os.unlink(os.path.join(self.path, name))
+					except OSError:
+						pass
+
+# Order notifications, unless a shared hub is configured
+event_bus = EventBus()
+
+def get_event_bus():
+	"""
+	Returns the notifications hub of the current app.
+	"""
+	return current_app.config['EVENT_BUS'] or event_bus
+
+def order_event(event, data):
+	"""
+	Returns a stores feed message about an order.
+	"""
+	return {
+		'event': event,
+		'data': json.dumps(data)
+	}
+
+def notify_stores(store_ids, message):
+	"""
+	Publishes the given message on the feed of every
+	given store.
+	"""
+	for store_id in store_ids:
+		get_event_bus().publish(STORE_CHANNEL % store_id, message)
+
+def notify_order(order_id):
+	"""
+	Wakes the requests waiting for the given order to
+	change.
+	"""
+	get_event_bus().publish(ORDER_CHANNEL % order_id, order_event('change', { 'id': order_id }))
+
+# ###############################################
+# ################## Pagination #################
+# ###############################################
+
+def encode_cursor(order):
+	"""
+	Returns the opaque cursor pointing right after the
+	given order in (created_at, id) descending order.
+	"""
+	key = '%s|%d' % (order.created_at.strftime(CURSOR_DATE_FORMAT), order.id)
+	return base64.urlsafe_b64encode(key).rstrip('=')
+
+def decode_cursor(cursor):
+	"""
+	Returns the (created_at, id) pair held by the given
+	cursor, aborts the request if it is not valid.
+	"""
+	try:
+		cursor = str(cursor)
+		created_at, order_id = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).split('|')
+		return datetime.strptime(created_at, CURSOR_DATE_FORMAT), int(order_id)
+	except (TypeError, ValueError):
+		abort(400)
+
+def page_args():
+	"""
+	Returns the page size and the (created_at, id) key to
+	seek after from the "limit" and "cursor" request
+	arguments, aborts the request if they are not valid.
+	"""
+	limit = request.args.get('limit', DEFAULT_PAGE_LIMIT)
+	try:
+		limit = int(limit)
+	except ValueError:
+		abort(400)
+	if limit < 1 or limit > MAX_PAGE_LIMIT:
+		abort(400)
+	cursor = request.args.get('cursor', None)
+	return limit, decode_cursor(cursor) if cursor else None
+
+def seek_orders(query, model, limit, after):
+	"""
+	Returns up to limit + 1 orders of the given model
+	matched by the given query right after the given
+	(created_at, id) key, in descending order.
+	"""
+	if after:
+		created_at, order_id = after
+		query = query.filter(or_(
+			model.created_at < created_at,
+			and_(model.created_at == created_at, model.id < order_id)
+		))
+	return query.order_by(desc(model.created_at), desc(model.id)).limit(limit + 1).all()
+
+def split_page(orders, limit):
+	"""
+	Returns the page of the given limit + 1 sorted orders
+	and the cursor of the next page (None on the last one).
+	"""
+	if len(orders) > limit:
+		return orders[:limit], encode_cursor(orders[limit - 1])
+	return orders, None
+
+def paginate_orders(query):
+	"""
+	Returns a page of the orders matched by the given query
+	and the cursor of the next page (None on the last one),
+	using the "limit" and "cursor" request arguments. Pages
+	are seeked by (created_at, id), so their cost does not
+	depend on how deep the client scrolls.
+	"""
+	limit, after = page_args()
+	return split_page(seek_orders(query, Order, limit, after), limit)
+
+# ###############################################
+# ############### Sparse fieldsets ##############
+# ###############################################
+
+# Columns and value of every field of the order list
+# serialization, the items are loaded apart
+ORDER_LIST_FIELDS = OrderedDict([
+	('id', (('id',), lambda row: row.id)),
+	('place', (('place',), lambda row: row.place)),
+	('status', (('status',), lambda row: ORDER_STATUS_MESSAGES[row.status])),
+	('price', (('price',), lambda row: row.price)),
+	('time', (('time',), lambda row: row.time)),
+	('geoplace', (('lat', 'lon'), lambda row: { 'lat': str(row.lat), 'lon': str(row.lon) })),
+	('user_id', (('user_id',), lambda row: row.user_id)),
+	('store_id', (('store_id',), lambda row: row.store_id)),
+	('items', ((), None)),
+	('rating', ((), lambda row: {
+		'id': row.rating_id,
+		'stars': row.rating_stars,
+		'comment': row.rating_comment
+	} if row.rating_id is not None else {})),
+	('created_at', (('created_at',), lambda row: row.created_at))
+])
+
+# Columns and value of every field of Store.serialize
+STORE_FIELDS = OrderedDict([
+	('id', (('id',), lambda store: store.id)),
+	('name', (('name',), lambda store: store.name)),
+	('place', (('place',), lambda store: store.place)),
+	('stars', (('stars',), lambda store: store.stars)),
+	('geoplace', (('lat', 'lon'), lambda store: { 'lat': float(store.lat), 'lon': float(store.lon) })),
+	('created_at', (('created_at',), lambda store: store.created_at)),
+	('user_id', (('user_id',), lambda store: store.user_id))
+])
+
+def requested_fields(available):
+	"""
+	Returns the fields listed, comma separated, in the
+	"fields" request argument or all the available ones
+	if it is missing, aborts the request if any of them
+	is unknown.
+	"""
+	fields = request.args.get('fields', None)
+	if fields is None:
+		return list(available)
+	fields = [field for field in fields.split(',') if field]
+	if not fields or any(field not in available for field in fields):
+		abort(400)
+	return fields
+
+def field_columns(model, available, fields, required=()):
+	"""
+	Returns the columns of the given model needed by the
+	given fields and the required ones, in table order.
+	"""
+	names = set(required)
+	for field in fields:
+		names.update(available[field][0])
+	return [getattr(model, column.name) for column in model.__table__.columns if column.name in names]
+
+def serialize_fields(row, available, fields):
+	"""
+	Returns the serialization of the given fields of the
+	given row or model.
+	"""
+	return dict((field, available[field][1](row)) for field in fields)
+
+# ###############################################
+# ############### Order functions ###############
+# ###############################################
+
+def format_price(price):
+	"""
+	Returns the given offer price as a plain decimal
+	string without trailing zeros.
+	"""
+	if price is None:
+		return None
+	price = '%.2f' % price
+	return price.rstrip('0').rstrip('.') if '.' in price else price
+
+def format_minutes(interval):
+	"""
+	Returns the given offer time as a string of minutes.
+	"""
+	if interval is None:
+		return None
+	return str(int(interval.total_seconds()) // 60)
+
+def serialize_offer_row(row):
+	"""
+	Returns the serialization of an offer from its (id,
+	price, time, order_id, store_id, stars) row, the stars
+	being those of its store.
+	"""
+	offer_id, price, offer_time, order_id, store_id, stars = row
+	return {
+		'id': offer_id,
+		'price': format_price(price),
+		'time': format_minutes(offer_time),
+		'order_id': order_id,
+		'store_id': store_id,
+		'stars': stars
+	}
+
+def order_etag(order_id, revision):
+	"""
+	Returns the ETag of the given order revision.
+	"""
+	return '%d-%d' % (order_id, revision)
+
+def orders_etag(user_id, versions, next_cursor, fields):
+	"""
+	Returns the ETag of a page of orders given the
+	(id, revision) pairs of its orders and the fields
+	serialized.
+	"""
+	key = [user_id, next_cursor, fields] + [order_etag(version.id, version.revision) for version in versions]
+	return hashlib.sha1(json.dumps(key)).hexdigest()
+
+def order_list_query(tables=HOT_TABLES, fields=ORDER_LIST_FIELDS):
+	"""
+	Returns a query of the columns of the given order
+	list fields from the given (orders, items, ratings)
+	tables as plain tuples, skipping the ORM identity
+	map. The id and created_at columns, which pages are
+	seeked by, are always included.
+	"""
+	order, item, rating = tables
+	query = session.query(*field_columns(order, ORDER_LIST_FIELDS, fields, ('id', 'created_at')))
+	if 'rating' in fields:
+		query = query.add_columns(
+			rating.id.label('rating_id'),
+			rating.stars.label('rating_stars'),
+			rating.comment.label('rating_comment')
+		).outerjoin(rating, rating.order_id == order.id)
+	return query
+
+def serialize_order_rows(rows, item=Item, fields=ORDER_LIST_FIELDS):
+	"""
+	Returns the serialization of the given fields of the
+	given order list rows, loading their items from the
+	given table in a single query when they are asked for.
+	With every field the output is the same as
+	Order.serialize.
+	"""
+	items = {}
+	if rows and 'items' in fields:
+		query = session.query(item.order_id, item.id, item.amount, item.name).filter(item.order_id.in_([row.id for row in rows]))
+		for order_id, item_id, amount, name in query.order_by(item.id):
+			items.setdefault(order_id, []).append({
+				'id': item_id,
+				'amount': amount,
+				'name': name
+			})
+	started = time.time()
+	values = [field for field in fields if field != 'items']
+	serialized = []
+	for row in rows:
+		order = serialize_fields(row, ORDER_LIST_FIELDS, values)
+		if 'items' in fields:
+			order['items'] = items.get(row.id, [])
+		serialized.append(order)
+	record_timing('serialize', time.time() - started)
+	return serialized
+
+def candidate_stores(points):
+	"""
+	Returns, for each of the given (lat, lon) points, the
+	ids of the stores whose radius covers it, nearest first.
+	The stores of every point's coverage cell are loaded
+	in a single query and then checked by exact distance.
+	"""
+	cells = [grid_cell(lat, lon, COVERAGE_CELL_DEGREES) for lat, lon in points]
+	stores = {}
+	if cells:
+		query = session.query(StoreCell.lat_cell, StoreCell.lon_cell, Store.id, Store.lat, Store.lon, Store.rad).join(Store, Store.id == StoreCell.store_id)
+		query = query.filter(or_(*[and_(StoreCell.lat_cell == lat_cell, StoreCell.lon_cell == lon_cell) for lat_cell, lon_cell in set(cells)]))
+		for lat_cell, lon_cell, store_id, lat, lon, rad in query:
+			stores.setdefault((lat_cell, lon_cell), []).append((store_id, lat, lon, rad or DEFAULT_ORDER_RADIUS))
+	candidates = []
+	for (lat, lon), cell in zip(points, cells):
+		near = [(distance(lat, lon, store_lat, store_lon), rad, store_id) for store_id, store_lat, store_lon, rad in stores.get(cell, [])]
+		candidates.append([store_id for length, rad, store_id in sorted(near) if length <= rad])
+	return candidates
+
+# Creates an offer in a single round trip, the conditional
+# update locks the order row so concurrent offers on it
+# are checked one after the other
+OFFER_INSERT_SQL = text("""
+	WITH bumped AS (
+		UPDATE orders SET offer_count = offer_count + 1, revision = revision + 1
+		WHERE id = :order_id AND status = :made AND offer_count < :offer_limit
+		AND EXISTS (SELECT 1 FROM stores WHERE id = :store_id)
+		AND (SELECT count(*) FROM orders AS accepted JOIN stores ON accepted.store_id = stores.id
+			WHERE stores.user_id = :user_id AND accepted.status = :accepted) < :store_limit
+		RETURNING id
+	), inserted AS (
+		INSERT INTO offers (id, price, "time", order_id, store_id)
+		SELECT nextval('offer_id_seq'), :price, :time, bumped.id, :store_id FROM bumped
+		RETURNING id, price, "time", order_id, store_id
+	)
+	SELECT inserted.id, inserted.price, inserted."time", inserted.order_id, inserted.store_id, stores.stars
+	FROM inserted JOIN stores ON stores.id = inserted.store_id
+""")
+
+def insert_offer(user_id, order_id, store_id, price, time):
+	"""
+	Creates an offer only if the order is still made and
+	under its offers limit and the user's store is under
+	its accepted orders limit, bumping the order's offers
+	count and revision. Returns the (id, price, time,
+	order_id, store_id, stars) row of the new offer, or
+	None when a check fails. A second offer of the same
+	store on the order raises an IntegrityError.
+	"""
+	if session.get_bind().dialect.name == 'postgresql':
+		return session.execute(OFFER_INSERT_SQL, {
+			'order_id': order_id,
+			'store_id': store_id,
+			'user_id': user_id,
+			'price': price,
+			'time': time,
+			'made': ORDER_MADE,
+			'accepted': ORDER_ACCEPTED,
+			'offer_limit': OFFER_ORDER_LIMIT,
+			'store_limit': STORE_ORDER_LIMIT
+		}).first()
+	# Databases without DML in CTEs run the same checks in
+	# a conditional update followed by the insert
+	accepted = Order.__table__.alias('accepted')
+	accepted_orders = select([func.count()]).select_from(accepted.join(Store.__table__, accepted.c.store_id == Store.id))
+	accepted_orders = accepted_orders.where(and_(Store.user_id == user_id, accepted.c.status == ORDER_ACCEPTED)).as_scalar()
+	bumped = session.query(Order).filter(and_(
+		Order.id == order_id,
+		Order.status == ORDER_MADE,
+		Order.offer_count < OFFER_ORDER_LIMIT,
+		exists().where(Store.id == store_id),
+		accepted_orders < STORE_ORDER_LIMIT
+	)).update({
+		Order.offer_count: Order.offer_count + 1,
+		Order.revision: Order.revision + 1
+	}, synchronize_session=False)
+	if not bumped:
+		return None
+	offer_id = insert_returning_ids(Offer.__table__, [{
+		'price': price,
+		'time': time,
+		'order_id': order_id,
+		'store_id': store_id
+	}])[0]
+	return (offer_id, price, time, order_id, store_id, session.query(Store.stars).filter(Store.id == store_id).scalar())
+
+def not_modified(etag):
+	"""
+	Returns an empty 304 response for the given ETag.
+	"""
+	response = make_response('', 304)
+	response.set_etag(etag)
+	return response
+
+def count_open_orders(user_id, batch=False):
+	"""
+	Returns the number of made and accepted orders of
+	the given user, made one by one or through the batch
+	endpoint, counted by the database.
+	"""
+	counts = dict(session.query(Order.status, func.count(Order.id)).filter(and_(Order.user_id == user_id, Order.batch == batch, Order.status != ORDER_FINISHED)).group_by(Order.status).all())
+	return counts.get(ORDER_MADE, 0), counts.get(ORDER_ACCEPTED, 0)
+
+def insert_returning_ids(table, rows):
+	"""
+	Inserts the given rows into the given table with a
+	single multi-row statement and returns their ids, on
+	databases without sequences and RETURNING the rows
+	are inserted one statement at a time.
+	"""
+	dialect = session.get_bind().dialect
+	if dialect.implicit_returning and dialect.supports_sequences:
+		sequence = table.c.id.default
+		rows = [dict(row, id=sequence.next_value()) for row in rows]
+		result = session.execute(table.insert().values(rows).returning(table.c.id))
+		return [row[0] for row in result]
+	return [session.execute(table.insert(), row).inserted_primary_key[0] for row in rows]
+
 # ###############################################
 # ############ No role API functions ############
 # ###############################################
 
-@app.route('/', methods=['GET'])
+@api.route('/', methods=['GET'])
 @requires_auth
+@read_only
 def index():
 	"""
 	Test the API is live by returning the token
@@ -297,71 +1595,189 @@ def index():
 	user = _request_ctx_stack.top.current_user
 	return jsonify(user), 200
 
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+	"""
+	Expose the request, token cache and replica metrics
+	in the Prometheus text format, steps to proceed are:
+		1. Render the request metrics.
+		2. Render the token cache counters, the replicas lag
+		   (NaN for the unreachable ones) and the requests
+		   being served.
+		3. Returns the metrics.
+	"""
+	# Step 1
+	lines = metrics.render()
+	# Step 2
+	lines += prometheus_metric('move_token_cache_hits_total', 'counter', 'Tokens found in the cache.', [('', {}, token_cache.hits)])
+	lines += prometheus_metric('move_token_cache_misses_total', 'counter', 'Tokens decoded and verified.', [('', {}, token_cache.misses)])
+	lags = [('', { 'replica': index }, float('nan') if lag is None else lag) for index, lag in enumerate(db.replica_lags())]
+	lines += prometheus_metric('move_replica_lag_seconds', 'gauge', 'Last measured lag of each read replica.', lags)
+	lines += prometheus_metric('move_active_requests', 'gauge', 'Requests being served.', [('', {}, active_requests.count)])
+	# Step 3
+	return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
 def get_orders(status):
 	"""
 	Retrieve all the existing orders as a user or as
 	a store, steps to proceed are:
-		1. Search all orders using the given user and status.
-		2. Returns every order found.
+		1. Search the ids and revisions of a page of orders
+		   using the given user and status, finished orders
+		   are searched in the archive too and merged.
+		2. Returns 304 if the client holds the page already.
+		3. Load the requested fields (all by default) of the
+		   page orders from the tables holding them.
+		4. Returns every order found and the next page cursor.
 	"""
 	# Step 1
-	orders = []
+	versions = []
 	user = _request_ctx_stack.top.current_user
 	user_id = user['sub'].split('|')[1]
-	if user['app_metadata']['user_role'] == 'user':
-		orders = session.query(Order).filter(and_(Order.user_id == user_id, Order.status == status)).order_by(desc(Order.created_at)).all()
-	elif user['app_metadata']['user_role'] == 'store':
-		orders = session.query(Order).join(Store).filter(and_(Store.user_id == user_id, Order.status == status)).order_by(desc(Order.created_at)).all()
+	fields = requested_fields(ORDER_LIST_FIELDS)
+	limit, after = page_args()
+	table_sets = (HOT_TABLES, ARCHIVE_TABLES) if status == ORDER_FINISHED else (HOT_TABLES,)
+	for source, tables in enumerate(table_sets):
+		order = tables[0]
+		query = session.query(order.id, order.revision, order.created_at, literal(source).label('source'))
+		if user['app_metadata']['user_role'] == 'user':
+			query = query.filter(and_(order.user_id == user_id, order.status == status))
+		elif user['app_metadata']['user_role'] == 'store':
+			query = query.join(Store, Store.id == order.store_id).filter(and_(Store.user_id == user_id, order.status == status))
+		else:
+			continue
+		versions += seek_orders(query, order, limit, after)
+	versions.sort(key=lambda version: (version.created_at, version.id), reverse=True)
+	versions, next_cursor = split_page(versions, limit)
+	etag = orders_etag(user_id, versions, next_cursor, fields)
 	# Step 2
-	return jsonify(json_list=[order.serialize for order in orders]), 200
+	if request.if_none_match.contains_weak(etag):
+		return not_modified(etag)
+	# Step 3
+	serialized = {}
+	for source, tables in enumerate(table_sets):
+		ids = [version.id for version in versions if version.source == source]
+		if ids:
+			rows = order_list_query(tables, fields).filter(tables[0].id.in_(ids)).all()
+			for row, order in zip(rows, serialize_order_rows(rows, tables[1], fields)):
+				serialized[source, row.id] = order
+	# Step 4
+	response = jsonify(json_list=[serialized[version.source, version.id] for version in versions], next_cursor=next_cursor)
+	response.set_etag(etag)
+	return response, 200
 
-@app.route('/api/v1.0/order/accepted', methods=['GET'])
+@api.route('/api/v1.0/order/accepted', methods=['GET'])
 @requires_auth
+@read_only
+@query_budget(3)
 def get_accepted_orders():
 	return get_orders(ORDER_ACCEPTED)
 
-@app.route('/api/v1.0/order/finished', methods=['GET'])
+@api.route('/api/v1.0/order/finished', methods=['GET'])
 @requires_auth
+@read_only
+@query_budget(6)
 def get_finished_orders():
 	return get_orders(ORDER_FINISHED)
 
-@app.route('/api/v1.0/order/<int:order_id>', methods=['GET'])
+@api.route('/api/v1.0/order/<int:order_id>', methods=['GET'])
 @requires_auth
+@read_only
 def get_order(order_id):
 	"""
 	Retrieve an specific order with a given id as a
 	user or as a store, steps to proceed are:
-		1. Search the order with the given id and user.
-		2. Returns the order if there is one.
+		1. Search the order revision with the given id and user,
+		   in the archive if it is not in the order tables.
+		2. When asked to wait for a change since the given
+		   version (ETag), wait until the order changes or the
+		   given seconds pass, releasing the connection.
+		   Archived orders do not change anymore.
+		3. Returns 304 if the client holds that revision already.
+		4. Load the order.
+		5. Returns the order if there is one.
 	"""
 	# Step 1
-	order = None
+	query = None
+	archived_query = None
 	user = _request_ctx_stack.top.current_user
 	user_id = user['sub'].split('|')[1]
 	if user['app_metadata']['user_role'] == 'user':
-		order = session.query(Order).filter(and_(Order.id == order_id, Order.user_id == user_id)).first()
+		query = session.query(Order).filter(and_(Order.id == order_id, Order.user_id == user_id))
+		archived_query = order_list_query(ARCHIVE_TABLES).filter(and_(ArchivedOrder.id == order_id, ArchivedOrder.user_id == user_id))
 	elif user['app_metadata']['user_role'] == 'store':
-		order = session.query(Order).join(Store).filter(and_(Order.id == order_id, Store.user_id == user_id)).first()
-	if not order:
+		query = session.query(Order).join(Store).filter(and_(Order.id == order_id, Store.user_id == user_id))
+		archived_query = order_list_query(ARCHIVE_TABLES).join(Store, Store.id == ArchivedOrder.store_id).filter(and_(ArchivedOrder.id == order_id, Store.user_id == user_id))
+	wait = request.args.get('wait', None)
+	since = request.args.get('since', None)
+	if since:
+		since = unquote_etag(since)[0]
+	if wait is not None and (not wait.isdigit() or not since):
+		abort(400)
+	# Subscribe before reading so no change goes unnoticed
+	queue = get_event_bus().subscribe(ORDER_CHANNEL % order_id) if wait and query else None
+	if queue:
+		# A lagging replica may miss a change already published
+		_request_ctx_stack.top.read_only = False
+	try:
+		revision = query.with_entities(Order.revision).scalar() if query else None
+		# Step 2
+		if queue and revision is not None and order_etag(order_id, revision) == since:
+			session.close()
+			# Parked requests do not count against the concurrency cap
+			active_requests.leave()
+			try:
+				queue.get(timeout=min(int(wait), MAX_WAIT_SECONDS))
+				# The change was just written, replicas may not have it yet
+				_request_ctx_stack.top.read_only = False
+			except Queue.Empty:
+				pass
+			finally:
+				active_requests.enter()
+			revision = query.with_entities(Order.revision).scalar()
+	finally:
+		if queue:
+			get_event_bus().unsubscribe(ORDER_CHANNEL % order_id, queue)
+	archived = False
+	if revision is None and archived_query is not None:
+		revision = archived_query.with_entities(ArchivedOrder.revision).scalar()
+		archived = revision is not None
+	if revision is None:
 		abort(404)
-	# Step 2
-	return jsonify(order.serialize), 200
+	# Step 3
+	etag = order_etag(order_id, revision)
+	if request.if_none_match.contains_weak(etag) or etag == since:
+		return not_modified(etag)
+	# Step 4
+	if archived:
+		serialized = serialize_order_rows(archived_query.all(), ArchivedItem)[0]
+	else:
+		order = query.first()
+		if not order:
+			abort(404)
+		serialized = order.serialize
+		etag = order_etag(order.id, order.revision)
+	# Step 5
+	response = jsonify(serialized)
+	response.set_etag(etag)
+	return response, 200
 
 # ###############################################
 # ########### User role API functions ###########
 # ###############################################
 
-@app.route('/api/v1.0/order', methods=['POST'])
+@api.route('/api/v1.0/order', methods=['POST'])
 @requires_auth
 def create_order():
 	"""
 	Make a new order as a user, steps to proceed are:
 		1. Check user's role is "user".
 		2. Check request data exists and is valid.
-		3. Check accepted orders limit is still valid.
+		3. Check accepted orders limit is still valid, the
+		   database rejects a concurrent second made order.
 		4. Create the new order using provided data.
 		5. Create every order item.
-		6. Returns the just created order.
+		6. Notify the stores covering the new order.
+		7. Returns the just created order.
 	"""
 	# Step 1
 	user = _request_ctx_stack.top.current_user
@@ -372,24 +1788,28 @@ def create_order():
 		abort(400)
 	# Step 3
 	user_id = user['sub'].split('|')[1]
-	orders = session.query(Order).filter(and_(Order.user_id == user_id, Order.status != ORDER_FINISHED)).all()
-	accepted_orders = [order for order in orders if order.status == ORDER_ACCEPTED]
-	made_order = [order for order in orders if order.status == ORDER_MADE]
-	if len(accepted_orders) >= USER_ORDER_LIMIT:
+	made_orders, accepted_orders = count_open_orders(user_id)
+	if accepted_orders >= USER_ORDER_LIMIT:
 		abort(400)
-	if len(made_order) > 0:
+	if made_orders > 0:
 		abort(400)
 	# Step 4
+	lat_cell, lon_cell = grid_cell(request.json['geoplace']['lat'], request.json['geoplace']['lon'])
 	order = Order(
 		place=request.json['place'],
 		status=ORDER_MADE,
 		lat=request.json['geoplace']['lat'],
 		lon=request.json['geoplace']['lon'],
+		lat_cell=lat_cell,
+		lon_cell=lon_cell,
 		user_id=user_id,
 		created_at=datetime.now()
 	)
 	session.add(order)
-	session.flush()
+	try:
+		session.flush()
+	except IntegrityError:
+		abort(400)
 	# Step 5
 	items = []
 	for val in request.json['items']:
@@ -402,20 +1822,121 @@ def create_order():
 	session.add_all(items)
 	session.commit()
 	# Step 6
-	return jsonify(order.serialize), 201
+	serialized = order.serialize
+	notify_stores(candidate_stores([(order.lat, order.lon)])[0], order_event('order', serialized))
+	# Step 7
+	return jsonify(serialized), 201
 
-@app.route('/api/v1.0/order/<int:order_id>', methods=['PUT'])
+@api.route('/api/v1.0/order/batch', methods=['POST'])
 @requires_auth
+def create_orders():
+	"""
+	Make many new orders at once as a user, e.g. a
+	business integration ordering for its customers.
+	Batch orders are exempt from the one made order and
+	accepted orders limits of single orders, they are
+	bounded by their own open orders limit instead. Steps
+	to proceed are:
+		1. Check user's role is "user".
+		2. Check request data exists and is valid.
+		3. Check every order data and the open batch orders
+		   limit, rejecting the orders that fail them.
+		4. Create the accepted orders in a single statement.
+		5. Create all their items in a single statement.
+		6. Notify the stores covering every new order.
+		7. Returns the result of every order, in order.
+	"""
+	# Step 1
+	user = _request_ctx_stack.top.current_user
+	if user['app_metadata']['user_role'] != 'user':
+		abort(401)
+	# Step 2
+	if not request.json or not valid_create_orders(request.json):
+		abort(400)
+	# Step 3
+	user_id = user['sub'].split('|')[1]
+	open_orders = sum(count_open_orders(user_id, batch=True))
+	accepted = []
+	for data in request.json['orders']:
+		valid = valid_create_order(data) and open_orders < BATCH_OPEN_ORDER_LIMIT
+		if valid:
+			open_orders += 1
+		accepted.append(valid)
+	# Step 4
+	created_at = datetime.now()
+	rows = []
+	for data in [order_data for order_data, order_valid in zip(request.json['orders'], accepted) if order_valid]:
+		lat_cell, lon_cell = grid_cell(data['geoplace']['lat'], data['geoplace']['lon'])
+		rows.append({
+			'place': data['place'],
+			'status': ORDER_MADE,
+			'lat': data['geoplace']['lat'],
+			'lon': data['geoplace']['lon'],
+			'lat_cell': lat_cell,
+			'lon_cell': lon_cell,
+			'user_id': user_id,
+			'batch': True,
+			'created_at': created_at,
+			'items': data['items']
+		})
+	order_ids = []
+	if rows:
+		try:
+			order_ids = insert_returning_ids(Order.__table__, [dict((k, v) for k, v in row.items() if k != 'items') for row in rows])
+		except IntegrityError:
+			abort(400)
+	# Step 5
+	items = []
+	for order_id, row in zip(order_ids, rows):
+		for val in row['items']:
+			items.append({
+				'amount': val['amount'],
+				'name': val['name'],
+				'order_id': order_id
+			})
+	if items:
+		insert_returning_ids(Item.__table__, items)
+	session.commit()
+	# Step 6
+	orders = {}
+	if order_ids:
+		query = session.query(Order).options(subqueryload(Order.items), joinedload(Order.rating))
+		created = query.filter(Order.id.in_(order_ids)).all()
+		for order, store_ids in zip(created, candidate_stores([(order.lat, order.lon) for order in created])):
+			orders[order.id] = order.serialize
+			notify_stores(store_ids, order_event('order', orders[order.id]))
+	# Step 7
+	results = []
+	created = iter(order_ids)
+	for valid in accepted:
+		if valid:
+			results.append({ 'status': 201, 'order': orders[next(created)] })
+		else:
+			results.append({ 'status': 400, 'error': 'bad request' })
+	return jsonify(json_list=results), 200
+
+@api.route('/api/v1.0/order/<int:order_id>', methods=['PUT'])
+@requires_auth
+@query_budget(6)
 def accept_offer(order_id):
 	"""
 	Accept a store's offer as a user, steps to proceed are:
 		1. Check user's role is "user".
 		2. Check request data exists and is valid.
-		3. Retrieve and check the offer with the given id.
-		4. Retrieve and check the order with the given id.
-		5. Modify and save the just retrieved order.
-		6. Retrieve and delete other offers.
-		7. Returns the just accepted order.
+		3. Retrieve the order status and the offer with the
+		   given id in one statement, returning 409 if the
+		   order is not made anymore and 404 if either is
+		   missing. The offers are deleted together with
+		   the status change, so a snapshot lacking the
+		   offer of a made order means it never existed.
+		4. Accept the order with the offer terms only if it
+		   is still made, returning 409 when another request
+		   changed it first.
+		5. Delete every offer of the order in one statement.
+		6. Load the accepted order columns, items and rating.
+		7. Notify the stores covering the order it is taken
+		   and wake the requests waiting for it.
+		8. Returns the just accepted order.
 	"""
 	# Step 1
 	user = _request_ctx_stack.top.current_user
@@ -425,31 +1946,40 @@ def accept_offer(order_id):
 	if not request.json or not valid_accept_offer(request.json):
 		abort(400)
 	# Step 3
-	offer = session.query(Offer).filter(and_(Offer.id == request.json['offer_id'], Offer.order_id == order_id)).first()
+	user_id = user['sub'].split('|')[1]
+	orders = session.query(Order).filter(and_(Order.id == order_id, Order.user_id == user_id))
+	offer = orders.outerjoin(Offer, and_(Offer.id == request.json['offer_id'], Offer.order_id == Order.id))\
+		.with_entities(Order.status, Offer.id, Offer.price, Offer.time, Offer.store_id).first()
 	if not offer:
 		abort(404)
-	# Step 4
-	user_id = user['sub'].split('|')[1]
-	order = session.query(Order).filter(and_(Order.id == order_id, Order.user_id == user_id)).first()
-	if not order:
+	if offer.status != ORDER_MADE:
+		abort(409)
+	if offer.id is None:
 		abort(404)
-	if order.status != ORDER_MADE:
-		abort(400)
+	# Step 4
+	accepted = orders.filter(Order.status == ORDER_MADE).update({
+		Order.status: ORDER_ACCEPTED,
+		Order.price: format_price(offer.price),
+		Order.time: format_minutes(offer.time),
+		Order.store_id: offer.store_id,
+		Order.revision: Order.revision + 1
+	}, synchronize_session=False)
+	if not accepted:
+		if not orders.with_entities(Order.id).first():
+			abort(404)
+		abort(409)
 	# Step 5
-	order.status = ORDER_ACCEPTED
-	order.price = offer.price
-	order.time = offer.time
-	order.store_id = offer.store_id
-	session.add(order)
-	# Step 6
-	offers = session.query(Offer).filter(Offer.order_id == order.id)
-	for offer in offers:
-		session.delete(offer)
+	session.query(Offer).filter(Offer.order_id == order_id).delete(synchronize_session=False)
 	session.commit()
+	# Step 6
+	rows = order_list_query().filter(Order.id == order_id).all()
 	# Step 7
-	return jsonify(order.serialize), 200
+	notify_stores(candidate_stores([(rows[0].lat, rows[0].lon)])[0], order_event('retract', { 'id': order_id }))
+	notify_order(order_id)
+	# Step 8
+	return jsonify(serialize_order_rows(rows)[0]), 200
 
-@app.route('/api/v1.0/order/<int:order_id>', methods=['DELETE'])
+@api.route('/api/v1.0/order/<int:order_id>', methods=['DELETE'])
 @requires_auth
 def delete_order(order_id):
 	"""
@@ -458,7 +1988,9 @@ def delete_order(order_id):
 		1. Check user's role is "user".
 		2. Search the order using the given id and user.
 		3. Delete the just retrieved order.
-		4. Returns an OK message and status.
+		4. Notify the stores covering the order it is gone
+		   and wake the requests waiting for it.
+		5. Returns an OK message and status.
 	"""
 	# Step 1
 	user = _request_ctx_stack.top.current_user
@@ -472,12 +2004,16 @@ def delete_order(order_id):
 	if order.status == ORDER_FINISHED:
 		abort(400)
 	# Step 3
+	store_ids = candidate_stores([(order.lat, order.lon)])[0]
 	session.delete(order)
 	session.commit()
 	# Step 4
+	notify_stores(store_ids, order_event('retract', { 'id': order_id }))
+	notify_order(order_id)
+	# Step 5
 	return jsonify({ 'msg': 'success' }), 200
 
-@app.route('/api/v1.0/rating', methods=['POST'])
+@api.route('/api/v1.0/rating', methods=['POST'])
 @requires_auth
 def rate_order():
 	"""
@@ -486,10 +2022,13 @@ def rate_order():
 		1. Check user's role is "user".
 		2. Check request data exists and is valid.
 		3. Search the order with the given id and user.
-		4. Create a new rating with the given data.
-		5. Update store's rating.
-		6. Change order's status to rated.
-		7. Returns the just created rating.
+		4. Change order's status to rated only if it is still
+		   accepted, returning 409 when another request rated
+		   it first.
+		5. Create a new rating with the given data.
+		6. Update store's rating counters and average.
+		7. Wake the requests waiting for the order.
+		8. Returns the just created rating.
 	"""
 	# Step 1
 	user = _request_ctx_stack.top.current_user
@@ -501,45 +2040,142 @@ def rate_order():
 	# Step 3
 	user_id = user['sub'].split('|')[1]
 	order_id = request.json['order_id']
-	order = session.query(Order).filter(and_(Order.id == order_id, Order.user_id == user_id)).first()
+	orders = session.query(Order).filter(and_(Order.id == order_id, Order.user_id == user_id))
+	order = orders.with_entities(Order.status, Order.store_id).first()
 	if not order:
 		abort(404)
 	if order.status != ORDER_ACCEPTED:
 		abort(400)
 	# Step 4
+	finished = orders.filter(Order.status == ORDER_ACCEPTED).update({
+		Order.status: ORDER_FINISHED,
+		Order.revision: Order.revision + 1
+	}, synchronize_session=False)
+	if not finished:
+		abort(409)
+	# Step 5
 	rating = Rating(
 		stars=request.json['stars'],
 		comment=request.json['comment'],
 		order_id=order_id
 	)
 	session.add(rating)
-	# Step 5
-	store_id = order.store_id
-	store = session.query(Store).filter(Store.id == store_id).first()
-	orders = session.query(Order).filter(and_(Order.store_id == store_id, Order.status == ORDER_FINISHED)).count()
-	store.stars = (store.stars * orders + rating.stars) / (orders + 1)
-	session.add(store)
 	# Step 6
-	order.status = ORDER_FINISHED
-	session.add(order);
+	session.query(Store).filter(Store.id == order.store_id).update({
+		Store.rating_count: Store.rating_count + 1,
+		Store.rating_sum: Store.rating_sum + rating.stars,
+		Store.stars: (Store.rating_sum + rating.stars) * 1.0 / (Store.rating_count + 1)
+	}, synchronize_session=False)
 	session.commit()
 	# Step 7
+	notify_order(order_id)
+	# Step 8
 	return jsonify(rating.serialize), 201
 
+@api.route('/api/v1.0/order/<int:order_id>/stores', methods=['GET'])
+@requires_auth
+@read_only
+@query_budget(3)
+def get_order_stores(order_id):
+	"""
+	Retrieve the stores that can serve an order as a
+	user, steps to proceed are:
+		1. Check user's role is "user".
+		2. Search the order using the given id and user.
+		3. Search the stores whose radius covers the order
+		   using their coverage cells, loading the requested
+		   fields (all by default).
+		4. Returns every store found, nearest first.
+	"""
+	# Step 1
+	user = _request_ctx_stack.top.current_user
+	if user['app_metadata']['user_role'] != 'user':
+		abort(401)
+	# Step 2
+	user_id = user['sub'].split('|')[1]
+	order = session.query(Order.lat, Order.lon).filter(and_(Order.id == order_id, Order.user_id == user_id)).first()
+	if not order:
+		abort(404)
+	# Step 3
+	fields = requested_fields(STORE_FIELDS)
+	store_ids = candidate_stores([(order.lat, order.lon)])[0]
+	stores = {}
+	if store_ids:
+		query = session.query(*field_columns(Store, STORE_FIELDS, fields, ('id',))).filter(Store.id.in_(store_ids))
+		stores = dict((store.id, serialize_fields(store, STORE_FIELDS, fields)) for store in query)
+	# Step 4
+	return jsonify(json_list=[stores[store_id] for store_id in store_ids]), 200
+
+@api.route('/api/v1.0/order/<int:order_id>/offers', methods=['GET'])
+@requires_auth
+@read_only
+@query_budget(2)
+def get_order_offers(order_id):
+	"""
+	Retrieve the offers made on an order as a user,
+	steps to proceed are:
+		1. Check user's role is "user".
+		2. Check the requested sorting, by price, time or
+		   stars, descending when prefixed with "-".
+		3. Search the order using the given id and user.
+		4. Search the order offers joined with their stores,
+		   sorted by the database.
+		5. Returns every offer found with its store.
+	"""
+	# Step 1
+	user = _request_ctx_stack.top.current_user
+	if user['app_metadata']['user_role'] != 'user':
+		abort(401)
+	# Step 2
+	sort = request.args.get('sort', 'price')
+	direction = desc if sort.startswith('-') else asc
+	columns = { 'price': Offer.price, 'time': Offer.time, 'stars': Store.stars }
+	if sort.lstrip('-') not in columns:
+		abort(400)
+	column = columns[sort.lstrip('-')]
+	# Step 3
+	user_id = user['sub'].split('|')[1]
+	if not session.query(Order.id).filter(and_(Order.id == order_id, Order.user_id == user_id)).first():
+		abort(404)
+	# Step 4
+	query = session.query(Offer.id, Offer.price, Offer.time, Offer.order_id, Offer.store_id, Store.stars, Store.name, Store.place, Store.lat, Store.lon)
+	query = query.join(Store, Store.id == Offer.store_id).filter(Offer.order_id == order_id).order_by(direction(column), Offer.id)
+	# Step 5
+	offers = []
+	for row in query:
+		offer = serialize_offer_row(row[:6])
+		offer['store'] = {
+			'id': row.store_id,
+			'name': row.name,
+			'place': row.place,
+			'stars': row.stars,
+			'geoplace': {
+				'lat': float(row.lat),
+				'lon': float(row.lon)
+			}
+		}
+		offers.append(offer)
+	return jsonify(json_list=offers), 200
+
 # ###############################################
 # ########## Store role API functions ###########
 # ###############################################
 
-@app.route('/api/v1.0/store/<int:store_id>/order/nearme', methods=['GET'])
+@api.route('/api/v1.0/store/<int:store_id>/order/nearme', methods=['GET'])
 @requires_auth
+@read_only
+@query_budget(3)
 def get_nearme_orders(store_id):
 	"""
 	Retrieve all the existing orders as a user or as
 	a store, steps to proceed are:
 		1. Check user's role is "store".
 		2. Retrieve and check the store with the given id.
-		3. Search all near orders using the store's location.
-		4. Returns every order found.
+		3. Search a page of near orders using the store's
+		   location, narrowing first by the grid cells covering
+		   the store's radius and then by the exact distance,
+		   loading the requested fields (all by default).
+		4. Returns every order found and the next page cursor.
 	"""
 	# Step 1
 	user = _request_ctx_stack.top.current_user
@@ -558,24 +2194,68 @@ def get_nearme_orders(store_id):
 			   func.radians(store.lon)) +\
 			   func.sin(func.radians(store.lat)) *\
 			   func.sin(func.radians(Order.lat)))
-	orders = session.query(Order).filter(and_(distance <= radius, Order.status == ORDER_MADE)).order_by(desc(Order.created_at)).all()
+	cells = cells_filter(Order, store.lat, store.lon, radius)
+	fields = requested_fields(ORDER_LIST_FIELDS)
+	query = order_list_query(fields=fields).filter(and_(Order.status == ORDER_MADE, cells, distance <= radius))
+	rows, next_cursor = paginate_orders(query)
 	# Step 4
-	return jsonify(json_list=[order.serialize for order in orders]), 200
+	return jsonify(json_list=serialize_order_rows(rows, fields=fields), next_cursor=next_cursor), 200
 
-@app.route('/api/v1.0/offer', methods=['POST'])
+@api.route('/api/v1.0/store/<int:store_id>/order/nearme/stream', methods=['GET'])
+@requires_auth
+@read_only
+def stream_nearme_orders(store_id):
+	"""
+	Stream the near orders as a store using server-sent
+	events, steps to proceed are:
+		1. Check user's role is "store".
+		2. Retrieve and check the store with the given id.
+		3. Subscribe to the store's feed.
+		4. Push every new order the store covers ("order"
+		   events) and every taken or cancelled one ("retract"
+		   events).
+	"""
+	# Step 1
+	user = _request_ctx_stack.top.current_user
+	if user['app_metadata']['user_role'] != 'store':
+		abort(401)
+	# Step 2
+	store = session.query(Store).filter(Store.id == store_id).first()
+	if not store:
+		abort(404)
+	# Step 3
+	channel = STORE_CHANNEL % store.id
+	bus = get_event_bus()
+	queue = bus.subscribe(channel)
+	# Step 4
+	def stream():
+		try:
+			while True:
+				try:
+					message = queue.get(timeout=STREAM_HEARTBEAT_SECONDS)
+				except Queue.Empty:
+					yield ': heartbeat\n\n'
+					continue
+				yield 'event: %s\ndata: %s\n\n' % (message['event'], message['data'])
+		finally:
+			bus.unsubscribe(channel, queue)
+	return Response(stream(), mimetype='text/event-stream', headers={ 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no' })
+
+@api.route('/api/v1.0/offer', methods=['POST'])
 @requires_auth
 def create_offer():
 	"""
 	Make a new offer as a store, steps to proceed are:
 		1. Check user's role is "store".
 		2. Check request data exists and is valid.
-		3. Retrieve and check the offer with the given id.
-		4. Retrieve and check the store with the given id.
-		5. Check accepted orders limit is still valid.
-		6. Check order's offers limit is still valid.
-		7. Check store has not made an offer already.
-		8. Create the new offer using provided data.
-		9. Returns the just created order.
+		3. Create the new offer only if the order is still
+		   made and under its offers limit, the store is under
+		   its accepted orders limit and has not offered on
+		   the order yet, bumping the order's revision.
+		4. Check the order and the store exist when the
+		   offer was not created.
+		5. Wake the requests waiting for the order.
+		6. Returns the just created offer.
 	"""
 	# Step 1
 	user = _request_ctx_stack.top.current_user
@@ -585,41 +2265,25 @@ def create_offer():
 	if not request.json or not valid_create_offer(request.json):
 		abort(400)
 	# Step 3
+	user_id = user['sub'].split('|')[1]
 	order_id = request.json['order_id']
-	order = session.query(Order).filter(Order.id == order_id).first()
-	if not order:
-		abort(404)
-	if order.status != ORDER_MADE:
-		abort(400)
-	# Step 4
 	store_id = request.json['store_id']
-	store = session.query(Order).filter(Store.id == store_id).first()
-	if not store:
-		abort(404)
-	# Step 5
-	user_id = user['sub'].split('|')[1]
-	orders = session.query(Order).join(Store).filter(and_(Store.user_id == user_id, Order.status == ORDER_ACCEPTED)).all()
-	if len(orders) >= STORE_ORDER_LIMIT:
-		abort(400)
-	# Step 6
-	offers = session.query(Offer).filter(Offer.order_id == order_id).all()
-	if len(offers) >= OFFER_ORDER_LIMIT:
+	try:
+		offer = insert_offer(user_id, order_id, store_id, Decimal(request.json['price']), timedelta(minutes=int(request.json['time'])))
+	except IntegrityError:
 		abort(400)
-	# Step 7
-	offer = session.query(Offer).filter(Offer.store_id == store_id).first()
-	if offer:
+	# Step 4
+	if not offer:
+		if not session.query(Order.id).filter(Order.id == order_id).first():
+			abort(404)
+		if not session.query(Store.id).filter(Store.id == store_id).first():
+			abort(404)
 		abort(400)
-	# Step 8
-	offer = Offer(
-		price=request.json['price'],
-		time=request.json['time'],
-		order_id=request.json['order_id'],
-		store_id=request.json['store_id']
-	)
-	session.add(offer)
 	session.commit()
-	# Step 9
-	return jsonify(offer.serialize), 201
+	# Step 5
+	notify_order(order_id)
+	# Step 6
+	return jsonify(serialize_offer_row(offer)), 201
 
 # ###############################################
 # ########### Verification functions ############
@@ -670,6 +2334,27 @@ def valid_create_order(data):
 			return False
 	return True
 
+def valid_create_orders(data):
+	"""
+	Verifies that the given data match correctly
+	with the following structure:
+		{
+			"orders": [
+				Order (see valid_create_order),
+				...
+			]
+		}
+	Every order is verified on its own afterwards.
+	"""
+	if 'orders' not in data or type(data['orders']) is not list:
+		return False
+	if len(data['orders']) < 1 or len(data['orders']) > BATCH_ORDER_LIMIT:
+		return False
+	for order in data['orders']:
+		if type(order) is not dict:
+			return False
+	return True
+
 def valid_accept_offer(data):
 	"""
 	Verifies that the given data match correctly
@@ -705,15 +2390,15 @@ def valid_create_offer(data):
 	Verifies that the given data match correctly
 	with the following structure:
 		{
-			"price": String,
-			"time": String,
+			"price": String (decimal, up to 2 places),
+			"time": String (minutes),
 			"order_id": FK,
 			"store_id": FK
 		}
 	"""
-	if 'price' not in data or type(data['price']) is not unicode or not data['price']:
+	if 'price' not in data or type(data['price']) is not unicode or not re.match(r'^\d{1,10}(\.\d{1,2})?$', data['price']):
 		return False
-	if 'time' not in data or type(data['time']) is not unicode or not data['time']:
+	if 'time' not in data or type(data['time']) is not unicode or not re.match(r'^\d{1,6}$', data['time']):
 		return False
 	if 'order_id' not in data:
 		return False
@@ -725,5 +2410,88 @@ def valid_create_offer(data):
 # ################ Run functions ################
 # ###############################################
 
+def backfill_ratings():
+	"""
+	Initializes every store's rating counters and
+	average from its existing ratings, archived or not.
+	"""
+	rating_count = 0
+	rating_sum = 0
+	for order, item, rating in (HOT_TABLES, ARCHIVE_TABLES):
+		ratings = rating.__table__.join(order.__table__, rating.order_id == order.id)
+		rating_count += select([func.count(rating.id)]).select_from(ratings).where(order.store_id == Store.id).as_scalar()
+		rating_sum += select([func.coalesce(func.sum(rating.stars), 0)]).select_from(ratings).where(order.store_id == Store.id).as_scalar()
+	session.query(Store).update({
+		Store.rating_count: rating_count,
+		Store.rating_sum: rating_sum,
+		Store.stars: case([(rating_count > 0, rating_sum * 1.0 / rating_count)], else_=Store.stars)
+	}, synchronize_session=False)
+	session.commit()
+
+def rebuild_store_cells():
+	"""
+	Rebuilds the coverage cells of every store, needed
+	after loading stores without the ORM.
+	"""
+	session.execute(StoreCell.__table__.delete())
+	stores = session.query(Store.id, Store.lat, Store.lon, Store.rad).all()
+	for start in range(0, len(stores), 100):
+		rows = [row for store in stores[start:start + 100] for row in store_cells(*store)]
+		if rows:
+			session.execute(StoreCell.__table__.insert(), rows)
+	session.commit()
+
+def archive_orders(days=ARCHIVE_AFTER_DAYS):
+	"""
+	Moves the finished orders older than the given number
+	of days, with their items and ratings, to the archive
+	tables in batches, committing after each one.
+	"""
+	cutoff = datetime.now() - timedelta(days=float(days))
+	order_columns = [column.name for column in ArchivedOrder.__table__.columns]
+	item_columns = [column.name for column in ArchivedItem.__table__.columns]
+	rating_columns = [column.name for column in ArchivedRating.__table__.columns]
+	while True:
+		ids = [order_id for order_id, in session.query(Order.id).filter(and_(Order.status == ORDER_FINISHED, Order.created_at < cutoff)).order_by(Order.id).limit(ARCHIVE_BATCH_SIZE)]
+		if not ids:
+			break
+		session.execute(ArchivedOrder.__table__.insert().from_select(order_columns,
+			select([Order.__table__.c[name] for name in order_columns]).where(Order.id.in_(ids))))
+		session.execute(ArchivedItem.__table__.insert().from_select(item_columns,
+			select([Item.__table__.c[name] for name in item_columns]).where(Item.order_id.in_(ids))))
+		session.execute(ArchivedRating.__table__.insert().from_select(rating_columns,
+			select([Rating.__table__.c[name] for name in rating_columns]).where(Rating.order_id.in_(ids))))
+		session.execute(Rating.__table__.delete().where(Rating.order_id.in_(ids)))
+		session.execute(Item.__table__.delete().where(Item.order_id.in_(ids)))
+		session.execute(Offer.__table__.delete().where(Offer.order_id.in_(ids)))
+		session.execute(Order.__table__.delete().where(Order.id.in_(ids)))
+		session.commit()
+
+COMMANDS = {
+	'archive-orders': archive_orders,
+	'backfill-ratings': backfill_ratings,
+	'rebuild-store-cells': rebuild_store_cells
+}
+
+def create_app(config=None):
+	"""
+	Returns a new app configured from the environment
+	and the given settings. It does not touch the database,
+	the engine is created on the first query of each process.
+	"""
+	app = Flask(__name__)
+	app.config.update(load_config(config))
+	app.config['AUTH0_SECRET'] = decode_secret(app.config['AUTH0_CLIENT_SECRET'])
+	app.register_blueprint(api)
+	app.teardown_appcontext(teardown_appcontext)
+	db.configure(app.config)
+	return app
+
 if __name__ == '__main__':
-	app.run(debug=True)
+	if len(sys.argv) == 1:
+		create_app().run(debug=True, threaded=True)
+	elif sys.argv[1] in COMMANDS:
+		with create_app().app_context():
+			COMMANDS[sys.argv[1]](*sys.argv[2:])
+	else:
+		sys.exit('usage: %s [%s] [arguments]' % (sys.argv[0], '|'.join(sorted(COMMANDS))))
@@ -0,0 +1,201 @@
+#!flask/bin/python
+"""
+Benchmarks every API route in-process, steps to proceed
+are:
+	1. Point the app to a local database (a temporary
+	   SQLite file unless --db is given) and recreate its
+	   schema.
+	2. Seed it with the configured volumes, archiving the
+	   older half of the finished orders.
+	3. Call every route the configured number of times,
+	   preparing a fresh fixture before each call of the
+	   routes that change state.
+	4. Report the latency percentiles and the SQL statement
+	   count of every route.
+The database given with --db is wiped, use a throwaway one.
+"""
+import argparse
+import base64
+import math
+import os
+import tempfile
+import time
+
+from datetime import timedelta
+from decimal import Decimal
+
+def percentile(values, percent):
+	"""
+	Returns the nearest-rank percentile of the given
+	sorted values.
+	"""
+	index = int(math.ceil(percent / 100.0 * len(values))) - 1
+	return values[max(index, 0)]
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='Benchmark every API route in-process.')
+	parser.add_argument('--db', help='database URL to wipe and use, defaults to a temporary SQLite file')
+	parser.add_argument('--requests', type=int, default=50, help='requests per route')
+	parser.add_argument('--stores', type=int, default=50)
+	parser.add_argument('--users', type=int, default=500)
+	parser.add_argument('--orders', type=int, default=5000)
+	parser.add_argument('--items', type=int, default=2, help='items per order')
+	parser.add_argument('--offers', type=int, default=3, help='offers per made order')
+	parser.add_argument('--batch', type=int, default=10, help='orders per batch request')
+	parser.add_argument('--json', help='also write the results to this file')
+	return parser.parse_args()
+
+def main():
+	args = parse_args()
+	# Step 1
+	path = None
+	if not args.db:
+		handle, path = tempfile.mkstemp(suffix='.db')
+		os.close(handle)
+		args.db = 'sqlite:///%s' % path
+	os.environ['DB_URL'] = args.db
+	os.environ.setdefault('AUTH0_CLIENT_ID', 'bench')
+	os.environ.setdefault('AUTH0_CLIENT_SECRET', base64.b64encode('bench'))
+	from app import archive_orders, create_app, get_engine, Base, engine, session, Item, Offer, Order, Store, ORDER_ACCEPTED, ORDER_MADE
+	from flask import json
+	from seed import insert, order_row, seed, store_row, token
+	from sqlalchemy import event
+	# Measure the routes, not the rate limits, failing the ones over their SQL budget
+	app = create_app({ 'RATE_LIMIT_RATE': 0, 'ASSERT_QUERY_BUDGET': True })
+	Base.metadata.drop_all(engine)
+	Base.metadata.create_all(engine)
+	try:
+		# Step 2
+		started = time.time()
+		store_ids, made_ids = seed(args.stores, args.users, args.orders, args.items, args.offers)
+		archive_orders(args.orders / 2 / 1440.0)
+		session.remove()
+		print 'Seeded %d stores, %d users and %d orders in %.1fs' % (args.stores, args.users, args.orders, time.time() - started)
+
+		def prepare_order(user_id, status=ORDER_MADE, store_id=None, offer_store_id=None):
+			order_id = insert(Order.__table__, [order_row(user_id, status, store_id)])[0]
+			insert(Item.__table__, [{ 'amount': 1, 'name': 'Item', 'order_id': order_id }])
+			offer_id = None
+			if offer_store_id:
+				offer_id = insert(Offer.__table__, [{ 'price': Decimal('10000'), 'time': timedelta(minutes=30), 'order_id': order_id, 'store_id': offer_store_id }])[0]
+			session.commit()
+			session.remove()
+			return order_id, offer_id
+
+		def prepare_store(user_id):
+			store_id = insert(Store.__table__, [store_row(user_id, user_id)])[0]
+			session.commit()
+			session.remove()
+			return store_id
+
+		new_order = {
+			'place': u'Place',
+			'geoplace': { 'lat': 4.6097, 'lon': -74.0817 },
+			'items': [{ 'amount': 1, 'name': u'Item' } for n in range(args.items)]
+		}
+
+		# Every scenario returns the (method, url, role, user id, data) of its i-th request
+		def index(i):
+			return 'GET', '/', 'user', 'user0', None
+		def get_metrics(i):
+			return 'GET', '/metrics', 'user', 'user0', None
+		def get_accepted_orders(i):
+			return 'GET', '/api/v1.0/order/accepted', 'user', 'user%d' % (i % args.users), None
+		def get_finished_orders(i):
+			return 'GET', '/api/v1.0/order/finished', 'store', 'store%d' % (i % args.stores), None
+		def get_order(i):
+			n = i % len(made_ids)
+			return 'GET', '/api/v1.0/order/%d' % made_ids[n], 'user', 'user%d' % n, None
+		def get_order_stores(i):
+			n = i % len(made_ids)
+			return 'GET', '/api/v1.0/order/%d/stores' % made_ids[n], 'user', 'user%d' % n, None
+		def get_order_offers(i):
+			n = i % len(made_ids)
+			return 'GET', '/api/v1.0/order/%d/offers?sort=-stars' % made_ids[n], 'user', 'user%d' % n, None
+		def get_nearme_orders(i):
+			n = i % len(store_ids)
+			return 'GET', '/api/v1.0/store/%d/order/nearme' % store_ids[n], 'store', 'store%d' % n, None
+		def stream_nearme_orders(i):
+			n = i % len(store_ids)
+			return 'GET', '/api/v1.0/store/%d/order/nearme/stream' % store_ids[n], 'store', 'store%d' % n, None
+		def create_order(i):
+			return 'POST', '/api/v1.0/order', 'user', 'bench-create-%d' % i, new_order
+		def create_orders(i):
+			return 'POST', '/api/v1.0/order/batch', 'user', 'bench-batch-%d' % i, { 'orders': [new_order] * args.batch }
+		def accept_offer(i):
+			order_id, offer_id = prepare_order('bench-accept-%d' % i, offer_store_id=store_ids[0])
+			return 'PUT', '/api/v1.0/order/%d' % order_id, 'user', 'bench-accept-%d' % i, { 'offer_id': offer_id }
+		def delete_order(i):
+			order_id, _ = prepare_order('bench-delete-%d' % i)
+			return 'DELETE', '/api/v1.0/order/%d' % order_id, 'user', 'bench-delete-%d' % i, None
+		def rate_order(i):
+			order_id, _ = prepare_order('bench-rate-%d' % i, ORDER_ACCEPTED, store_ids[0])
+			return 'POST', '/api/v1.0/rating', 'user', 'bench-rate-%d' % i, { 'stars': 8, 'comment': u'Good', 'order_id': order_id }
+		def create_offer(i):
+			store_id = prepare_store('bench-offer-store-%d' % i)
+			order_id, _ = prepare_order('bench-offer-%d' % i)
+			return 'POST', '/api/v1.0/offer', 'store', 'bench-offer-store-%d' % i, { 'price': u'9000', 'time': u'20', 'order_id': order_id, 'store_id': store_id }
+
+		scenarios = [index, get_metrics, get_accepted_orders, get_finished_orders, get_order, get_order_stores, get_order_offers, get_nearme_orders, stream_nearme_orders,
+			create_order, create_orders, accept_offer, delete_order, rate_order, create_offer]
+		missing = set(rule.endpoint.split('.')[-1] for rule in app.url_map.iter_rules()) - set(scenario.__name__ for scenario in scenarios) - set(['static'])
+		if missing:
+			print 'Routes without a benchmark: %s' % ', '.join(sorted(missing))
+
+		# Step 3
+		statements = [0]
+		@event.listens_for(get_engine(), 'before_cursor_execute')
+		def count(conn, cursor, statement, parameters, context, executemany):
+			statements[0] += 1
+		client = app.test_client()
+		results = []
+		for scenario in scenarios:
+			latencies = []
+			counts = []
+			errors = 0
+			for i in range(args.requests):
+				method, url, role, user_id, data = scenario(i)
+				headers = {
+					'Authorization': 'Bearer %s' % token(role, user_id),
+					'Content-Type': 'application/json'
+				}
+				statements[0] = 0
+				started = time.time()
+				response = client.open(url, method=method, data=json.dumps(data) if data else None, headers=headers, buffered=not url.endswith('/stream'))
+				latencies.append((time.time() - started) * 1000)
+				failed = response.status_code >= 400
+				if not failed and scenario is create_orders:
+					# Every order of a batch answers its own status
+					failed = any(result['status'] >= 400 for result in json.loads(response.data)['json_list'])
+				response.close()
+				counts.append(statements[0])
+				if failed:
+					errors += 1
+			latencies.sort()
+			results.append({
+				'route': scenario.__name__,
+				'requests': args.requests,
+				'errors': errors,
+				'p50': percentile(latencies, 50),
+				'p90': percentile(latencies, 90),
+				'p99': percentile(latencies, 99),
+				'max': latencies[-1],
+				'statements': float(sum(counts)) / len(counts),
+				'max_statements': max(counts)
+			})
+		# Step 4
+		print '%-22s %8s %8s %8s %8s %8s %6s %6s' % ('route', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'errors', 'sql', 'max')
+		for result in results:
+			print '%-22s %8.2f %8.2f %8.2f %8.2f %8d %6.1f %6d' % (result['route'], result['p50'], result['p90'],
+				result['p99'], result['max'], result['errors'], result['statements'], result['max_statements'])
+		if args.json:
+			with open(args.json, 'w') as output:
+				json.dump(results, output, indent=2)
+	finally:
+		session.remove()
+		engine.dispose()
+		if path:
+			os.remove(path)
+
+if __name__ == '__main__':
+	main()
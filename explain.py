@@ -0,0 +1,142 @@
+#!flask/bin/python
+"""
+Runs EXPLAIN on every SQL statement issued by the API
+handlers against a seeded database and flags the ones
+scanning a whole table, steps to proceed are:
+	1. Seed the database with stores, orders, items,
+	   offers and ratings, archiving the oldest finished
+	   orders, plus a fresh store and user for the routes
+	   limiting their open orders.
+	2. Call every API route capturing its statements.
+	3. Explain every captured statement.
+	4. Report the plans, exiting with an error status if
+	   any of them scans a whole table or a route does not
+	   answer its expected status.
+The seed data is committed, use a throwaway database
+migrated to the latest revision.
+"""
+import argparse
+import re
+import sys
+
+from app import archive_orders, create_app, get_engine, Base, engine, session, Offer, Order, Store
+from flask import json
+from seed import CENTER, insert, seed, store_row, token
+from sqlalchemy import event
+
+# Routes that never return, so they can not be explained
+SKIPPED_ENDPOINTS = ['static', 'stream_nearme_orders']
+
+def explain(statement, parameters):
+	"""
+	Returns the plan lines of the given statement.
+	"""
+	connection = engine.raw_connection()
+	try:
+		cursor = connection.cursor()
+		if engine.dialect.name == 'sqlite':
+			cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+			return [row[-1] for row in cursor.fetchall()]
+		cursor.execute('EXPLAIN ' + statement, parameters)
+		return [row[0] for row in cursor.fetchall()]
+	finally:
+		connection.rollback()
+		connection.close()
+
+def full_scan(line):
+	"""
+	Returns whether the given plan line scans a whole table.
+	"""
+	if engine.dialect.name == 'sqlite':
+		# SQLite searches indexes and scans tables or subqueries
+		match = re.match(r'^SCAN (TABLE )?(\w+)', line.strip())
+		return match is not None and re.sub(r'_\d+$', '', match.group(2)) in Base.metadata.tables
+	return 'Seq Scan' in line
+
+def main():
+	parser = argparse.ArgumentParser(description='Explain the SQL statements of every API route.')
+	parser.add_argument('--stores', type=int, default=200)
+	parser.add_argument('--users', type=int, default=2000)
+	parser.add_argument('--orders', type=int, default=20000)
+	args = parser.parse_args()
+	# Every call must reach its route, failing the ones over their SQL budget
+	app = create_app({ 'RATE_LIMIT_RATE': 0, 'ASSERT_QUERY_BUDGET': True })
+	# Step 1
+	store_ids, order_ids = seed(args.stores, args.users, args.orders)
+	archive_orders(args.orders / 2 / 1440.0)
+	store_id, order_id, other_order_id = store_ids[0], order_ids[0], order_ids[1]
+	store = session.query(Store).get(store_id)
+	store_user = store.user_id
+	order_user = session.query(Order).get(order_id).user_id
+	offer = session.query(Offer).filter(Offer.order_id == order_id).first()
+	offer_id = offer.id
+	offer_store = session.query(Store).get(offer.store_id).user_id
+	other_order_user = session.query(Order).get(other_order_id).user_id
+	# Seeded stores and users may be at their open orders limits already
+	fresh_store_id = insert(Store.__table__, [store_row('Explain', 'explain-store')])[0]
+	session.commit()
+	session.remove()
+	# Step 2
+	statements = []
+	@event.listens_for(get_engine(), 'before_cursor_execute')
+	def capture(conn, cursor, statement, parameters, context, executemany):
+		if not executemany:
+			statements.append((statement, parameters))
+	new_order = {
+		'place': u'Place',
+		'geoplace': { 'lat': CENTER[0], 'lon': CENTER[1] },
+		'items': [{ 'amount': 1, 'name': u'Item' }]
+	}
+	# Every call is (method, url, role, user id, data, expected status)
+	calls = [
+		('GET', '/', 'user', order_user, None, 200),
+		('GET', '/metrics', 'user', order_user, None, 200),
+		('GET', '/api/v1.0/order/accepted', 'user', order_user, None, 200),
+		('GET', '/api/v1.0/order/accepted', 'store', store_user, None, 200),
+		('GET', '/api/v1.0/order/finished', 'user', order_user, None, 200),
+		('GET', '/api/v1.0/order/finished', 'store', store_user, None, 200),
+		('GET', '/api/v1.0/order/%d' % order_id, 'user', order_user, None, 200),
+		('GET', '/api/v1.0/order/%d/stores' % order_id, 'user', order_user, None, 200),
+		('GET', '/api/v1.0/store/%d/order/nearme' % store_id, 'store', store_user, None, 200),
+		('POST', '/api/v1.0/offer', 'store', 'explain-store', { 'price': u'9000', 'time': u'20', 'order_id': order_id, 'store_id': fresh_store_id }, 201),
+		('GET', '/api/v1.0/order/%d/offers?sort=-stars' % order_id, 'user', order_user, None, 200),
+		('PUT', '/api/v1.0/order/%d' % order_id, 'user', order_user, { 'offer_id': offer_id }, 200),
+		# Stores only see the orders they took
+		('GET', '/api/v1.0/order/%d' % order_id, 'store', offer_store, None, 200),
+		('POST', '/api/v1.0/rating', 'user', order_user, { 'stars': 8, 'comment': u'Good', 'order_id': order_id }, 201),
+		('POST', '/api/v1.0/order', 'user', 'explain-user', new_order, 201),
+		('POST', '/api/v1.0/order/batch', 'user', 'explain-batch', { 'orders': [new_order] }, 200),
+		('DELETE', '/api/v1.0/order/%d' % other_order_id, 'user', other_order_user, None, 200)
+	]
+	client = app.test_client()
+	endpoints = set()
+	failed = False
+	for method, url, role, user_id, data, expected in calls:
+		del statements[:]
+		response = client.open(url, method=method, data=json.dumps(data) if data else None, headers={
+			'Authorization': 'Bearer %s' % token(role, user_id),
+			'Content-Type': 'application/json'
+		})
+		endpoints.add(app.url_map.bind('').match(url.split('?')[0], method=method)[0].split('.')[-1])
+		status = response.status_code
+		if status == 200 and url.endswith('/batch'):
+			# Every order of a batch answers its own status
+			status = max([status] + [result['status'] for result in json.loads(response.data)['json_list'] if result['status'] >= 400])
+		print '%s %s (%s) -> %d%s' % (method, url, role, status, '' if status == expected else ' (expected %d)' % expected)
+		failed = failed or status != expected
+		# Step 3
+		for statement, parameters in list(statements):
+			plan = explain(statement, parameters)
+			scans = [line for line in plan if full_scan(line)]
+			failed = failed or bool(scans)
+			# Step 4
+			print '  %s %s' % ('SEQ SCAN' if scans else 'ok      ', ' '.join(statement.split())[:150])
+			for line in plan:
+				print '      %s' % line
+	missing = set(rule.endpoint.split('.')[-1] for rule in app.url_map.iter_rules()) - endpoints - set(SKIPPED_ENDPOINTS)
+	if missing:
+		print 'Routes not explained: %s' % ', '.join(sorted(missing))
+	sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+	main()
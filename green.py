@@ -0,0 +1,38 @@
+#!flask/bin/python
+"""
+Serves the app from a single process with gevent, steps
+to proceed are:
+	1. Make the standard library and the PostgreSQL
+	   driver cooperative, so waiting on a socket, a lock,
+	   a queue or the database yields to other requests.
+	2. Serve every connection in its own greenlet, up to
+	   the given number of connections.
+Long polls and streams then cost a greenlet each instead
+of a thread, while the database work of a process stays
+bounded by its pool and MAX_CONCURRENT_REQUESTS.
+"""
+# Step 1, before anything else imports the modules it patches
+from gevent import monkey
+monkey.patch_all()
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+import argparse
+
+from app import create_app
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+def main():
+	parser = argparse.ArgumentParser(description='Serve the API with gevent.')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=5000)
+	parser.add_argument('--connections', type=int, default=10000, help='connections served at once')
+	args = parser.parse_args()
+	# Step 2
+	server = WSGIServer((args.host, args.port), create_app(), spawn=Pool(args.connections))
+	print 'Serving on http://%s:%d' % (args.host, args.port)
+	server.serve_forever()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,37 @@
+from __future__ import with_statement
+import os
+import sys
+
+from alembic import context
+from logging.config import fileConfig
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import Base, engine
+
+# Alembic configuration
+config = context.config
+fileConfig(config.config_file_name)
+
+def run_migrations_offline():
+	"""
+	Emit the migrations SQL to the script output
+	instead of running it against the database.
+	"""
+	context.configure(url=engine.url, target_metadata=Base.metadata, literal_binds=True)
+	with context.begin_transaction():
+		context.run_migrations()
+
+def run_migrations_online():
+	"""
+	Run the migrations against the app's database.
+	"""
+	with engine.connect() as connection:
+		context.configure(connection=connection, target_metadata=Base.metadata)
+		with context.begin_transaction():
+			context.run_migrations()
+
+if context.is_offline_mode():
+	run_migrations_offline()
+else:
+	run_migrations_online()
@@ -0,0 +1,84 @@
+"""
+Initial schema, as created by the app before the
+migrations existed, databases that already have it
+are left as they are
+
+Revision ID: 0001
+Revises:
+Create Date: 2015-12-17 12:00:00
+"""
+
+# Revision identifiers
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+import sqlalchemy as sa
+
+from alembic import op
+
+SEQUENCES = ['store_id_seq', 'order_id_seq', 'item_id_seq', 'offer_id_seq', 'rating_id_seq']
+TABLES = ['stores', 'orders', 'items', 'offers', 'ratings']
+
+def upgrade():
+	# Databases created by the app's create_all already have this schema
+	if not op.get_context().as_sql:
+		existing = set(sa.inspect(op.get_bind()).get_table_names())
+		if existing.issuperset(TABLES):
+			return
+	if op.get_context().dialect.supports_sequences:
+		for name in SEQUENCES:
+			op.execute(sa.schema.CreateSequence(sa.Sequence(name)))
+	op.create_table('stores',
+		sa.Column('id', sa.Integer, sa.Sequence('store_id_seq'), primary_key=True),
+		sa.Column('name', sa.String(100)),
+		sa.Column('place', sa.String(100)),
+		sa.Column('stars', sa.Integer),
+		sa.Column('lat', sa.Numeric),
+		sa.Column('lon', sa.Numeric),
+		sa.Column('rad', sa.Integer),
+		sa.Column('user_id', sa.String(50), unique=True, nullable=False),
+		sa.Column('created_at', sa.DateTime)
+	)
+	op.create_table('orders',
+		sa.Column('id', sa.Integer, sa.Sequence('order_id_seq'), primary_key=True),
+		sa.Column('place', sa.String(100)),
+		sa.Column('status', sa.Integer),
+		sa.Column('price', sa.String(25)),
+		sa.Column('time', sa.String(25)),
+		sa.Column('lat', sa.Numeric),
+		sa.Column('lon', sa.Numeric),
+		sa.Column('user_id', sa.String(50)),
+		sa.Column('created_at', sa.DateTime),
+		sa.Column('store_id', sa.Integer, sa.ForeignKey('stores.id'))
+	)
+	op.create_table('items',
+		sa.Column('id', sa.Integer, sa.Sequence('item_id_seq'), primary_key=True),
+		sa.Column('amount', sa.Integer),
+		sa.Column('name', sa.String(100)),
+		sa.Column('order_id', sa.Integer, sa.ForeignKey('orders.id'))
+	)
+	op.create_table('offers',
+		sa.Column('id', sa.Integer, sa.Sequence('offer_id_seq'), primary_key=True),
+		sa.Column('price', sa.String(25)),
+		sa.Column('time', sa.String(25)),
+		sa.Column('order_id', sa.Integer, sa.ForeignKey('orders.id')),
+		sa.Column('store_id', sa.Integer, sa.ForeignKey('stores.id'))
+	)
+	op.create_table('ratings',
+		sa.Column('id', sa.Integer, sa.Sequence('rating_id_seq'), primary_key=True),
+		sa.Column('stars', sa.Integer),
+		sa.Column('comment', sa.String(200)),
+		sa.Column('order_id', sa.Integer, sa.ForeignKey('orders.id'))
+	)
+
+def downgrade():
+	op.drop_table('ratings')
+	op.drop_table('offers')
+	op.drop_table('items')
+	op.drop_table('orders')
+	op.drop_table('stores')
+	if op.get_context().dialect.supports_sequences:
+		for name in reversed(SEQUENCES):
+			op.execute(sa.schema.DropSequence(sa.Sequence(name)))
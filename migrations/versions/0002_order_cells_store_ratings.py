@@ -0,0 +1,58 @@
+"""
+Order grid cells, store rating counters and the
+order listing indexes
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-16 12:00:00
+"""
+
+# Revision identifiers
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# Grid cell size when this revision was written
+GRID_CELL_DEGREES = 0.01
+
+def upgrade():
+	# Order grid cells
+	op.add_column('orders', sa.Column('lat_cell', sa.Integer))
+	op.add_column('orders', sa.Column('lon_cell', sa.Integer))
+	op.execute(
+		'UPDATE orders SET lat_cell = floor(lat / %s), lon_cell = floor(lon / %s)' % (GRID_CELL_DEGREES, GRID_CELL_DEGREES)
+	)
+	# Store rating counters
+	with op.batch_alter_table('stores') as batch:
+		batch.alter_column('stars', type_=sa.Float)
+		batch.add_column(sa.Column('rating_count', sa.Integer, nullable=False, server_default='0'))
+		batch.add_column(sa.Column('rating_sum', sa.Integer, nullable=False, server_default='0'))
+	op.execute(
+		'UPDATE stores SET '
+		'rating_count = (SELECT count(ratings.id) FROM ratings JOIN orders ON ratings.order_id = orders.id WHERE orders.store_id = stores.id), '
+		'rating_sum = (SELECT coalesce(sum(ratings.stars), 0) FROM ratings JOIN orders ON ratings.order_id = orders.id WHERE orders.store_id = stores.id)'
+	)
+	op.execute('UPDATE stores SET stars = rating_sum * 1.0 / rating_count WHERE rating_count > 0')
+	# Order indexes
+	op.create_index('ix_orders_status_cell', 'orders', ['status', 'lat_cell', 'lon_cell'])
+	op.create_index('ix_orders_user_status_created', 'orders', ['user_id', 'status', 'created_at', 'id'])
+	op.create_index('ix_orders_store_status_created', 'orders', ['store_id', 'status', 'created_at', 'id'])
+	op.create_index('uq_orders_user_made', 'orders', ['user_id'], unique=True,
+		postgresql_where=sa.text('status = 0'), sqlite_where=sa.text('status = 0'))
+
+def downgrade():
+	op.drop_index('uq_orders_user_made', 'orders')
+	op.drop_index('ix_orders_store_status_created', 'orders')
+	op.drop_index('ix_orders_user_status_created', 'orders')
+	op.drop_index('ix_orders_status_cell', 'orders')
+	with op.batch_alter_table('stores') as batch:
+		batch.drop_column('rating_sum')
+		batch.drop_column('rating_count')
+		batch.alter_column('stars', type_=sa.Integer)
+	op.drop_column('orders', 'lon_cell')
+	op.drop_column('orders', 'lat_cell')
@@ -0,0 +1,28 @@
+"""
+Indexes on the foreign keys the handlers filter
+and join on
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-16 12:30:00
+"""
+
+# Revision identifiers
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+def upgrade():
+	op.create_index('ix_items_order_id', 'items', ['order_id'])
+	op.create_index('ix_offers_order_id', 'offers', ['order_id'])
+	op.create_index('ix_offers_store_id', 'offers', ['store_id'])
+	op.create_index('ix_ratings_order_id', 'ratings', ['order_id'])
+
+def downgrade():
+	op.drop_index('ix_ratings_order_id', 'ratings')
+	op.drop_index('ix_offers_store_id', 'offers')
+	op.drop_index('ix_offers_order_id', 'offers')
+	op.drop_index('ix_items_order_id', 'items')
@@ -0,0 +1,24 @@
+"""
+Order revisions for conditional GETs
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-16 13:00:00
+"""
+
+# Revision identifiers
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+import sqlalchemy as sa
+
+from alembic import op
+
+def upgrade():
+	op.add_column('orders', sa.Column('revision', sa.Integer, nullable=False, server_default='0'))
+
+def downgrade():
+	with op.batch_alter_table('orders') as batch:
+		batch.drop_column('revision')
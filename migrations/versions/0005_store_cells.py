@@ -0,0 +1,30 @@
+"""
+Store coverage cells, fill them by running
+./app.py rebuild-store-cells after upgrading
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-16 14:00:00
+"""
+
+# Revision identifiers
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+import sqlalchemy as sa
+
+from alembic import op
+
+def upgrade():
+	op.create_table('store_cells',
+		sa.Column('lat_cell', sa.Integer, primary_key=True, autoincrement=False),
+		sa.Column('lon_cell', sa.Integer, primary_key=True, autoincrement=False),
+		sa.Column('store_id', sa.Integer, sa.ForeignKey('stores.id', ondelete='CASCADE'), primary_key=True, autoincrement=False)
+	)
+	op.create_index('ix_store_cells_store_id', 'store_cells', ['store_id'])
+
+def downgrade():
+	op.drop_index('ix_store_cells_store_id', 'store_cells')
+	op.drop_table('store_cells')
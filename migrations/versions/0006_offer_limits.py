@@ -0,0 +1,30 @@
+"""
+Order offer counters and one offer per store and
+order
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-16 15:00:00
+"""
+
+# Revision identifiers
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+import sqlalchemy as sa
+
+from alembic import op
+
+def upgrade():
+	op.add_column('orders', sa.Column('offer_count', sa.Integer, nullable=False, server_default='0'))
+	op.execute('UPDATE orders SET offer_count = (SELECT count(offers.id) FROM offers WHERE offers.order_id = orders.id)')
+	with op.batch_alter_table('offers') as batch:
+		batch.create_unique_constraint('uq_offers_order_store', ['order_id', 'store_id'])
+
+def downgrade():
+	with op.batch_alter_table('offers') as batch:
+		batch.drop_constraint('uq_offers_order_store', type_='unique')
+	with op.batch_alter_table('orders') as batch:
+		batch.drop_column('offer_count')
@@ -0,0 +1,51 @@
+"""
+Offer prices as decimals and times as intervals,
+values that are not plain numbers become NULL
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-16 16:00:00
+"""
+
+# Revision identifiers
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+import sqlalchemy as sa
+
+from alembic import op
+
+def upgrade():
+	if op.get_context().dialect.name == 'postgresql':
+		op.execute(
+			"ALTER TABLE offers "
+			"ALTER COLUMN price TYPE numeric(12, 2) USING CASE WHEN price ~ '^[0-9]+(\\.[0-9]+)?$' THEN price::numeric END, "
+			"ALTER COLUMN time TYPE interval USING CASE WHEN time ~ '^[0-9]+$' THEN (time || ' minutes')::interval END"
+		)
+		return
+	# SQLite casts the copied values to the new column types
+	# and stores intervals as datetimes after the epoch
+	op.execute(
+		"UPDATE offers SET "
+		"price = CASE WHEN price GLOB '[0-9]*' AND price NOT GLOB '*[^0-9.]*' THEN price END, "
+		"time = CASE WHEN time GLOB '[0-9]*' AND time NOT GLOB '*[^0-9]*' THEN time END"
+	)
+	with op.batch_alter_table('offers') as batch:
+		batch.alter_column('price', type_=sa.Numeric(12, 2))
+		batch.alter_column('time', type_=sa.Interval)
+	op.execute("UPDATE offers SET time = datetime('1970-01-01', '+' || time || ' minutes') WHERE time IS NOT NULL")
+
+def downgrade():
+	if op.get_context().dialect.name == 'postgresql':
+		op.execute(
+			"ALTER TABLE offers "
+			"ALTER COLUMN price TYPE varchar(25) USING trim(trailing '.' from trim(trailing '0' from price::text)), "
+			"ALTER COLUMN time TYPE varchar(25) USING (extract(epoch from time)::integer / 60)::text"
+		)
+		return
+	op.execute("UPDATE offers SET time = CAST(round((julianday(time) - julianday('1970-01-01')) * 1440) AS INTEGER)")
+	with op.batch_alter_table('offers') as batch:
+		batch.alter_column('price', type_=sa.String(25))
+		batch.alter_column('time', type_=sa.String(25))
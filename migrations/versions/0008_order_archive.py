@@ -0,0 +1,58 @@
+"""
+Archive tables of the finished orders, fill them by
+running ./app.py archive-orders [days]
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-16 17:00:00
+"""
+
+# Revision identifiers
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+import sqlalchemy as sa
+
+from alembic import op
+
+def upgrade():
+	op.create_table('archived_orders',
+		sa.Column('id', sa.Integer, primary_key=True, autoincrement=False),
+		sa.Column('place', sa.String(100)),
+		sa.Column('status', sa.Integer),
+		sa.Column('price', sa.String(25)),
+		sa.Column('time', sa.String(25)),
+		sa.Column('lat', sa.Numeric),
+		sa.Column('lon', sa.Numeric),
+		sa.Column('user_id', sa.String(50)),
+		sa.Column('revision', sa.Integer, nullable=False, server_default='0'),
+		sa.Column('created_at', sa.DateTime),
+		sa.Column('store_id', sa.Integer, sa.ForeignKey('stores.id'))
+	)
+	op.create_index('ix_archived_orders_user_created', 'archived_orders', ['user_id', 'created_at', 'id'])
+	op.create_index('ix_archived_orders_store_created', 'archived_orders', ['store_id', 'created_at', 'id'])
+	op.create_table('archived_items',
+		sa.Column('id', sa.Integer, primary_key=True, autoincrement=False),
+		sa.Column('amount', sa.Integer),
+		sa.Column('name', sa.String(100)),
+		sa.Column('order_id', sa.Integer, sa.ForeignKey('archived_orders.id'))
+	)
+	op.create_index('ix_archived_items_order_id', 'archived_items', ['order_id'])
+	op.create_table('archived_ratings',
+		sa.Column('id', sa.Integer, primary_key=True, autoincrement=False),
+		sa.Column('stars', sa.Integer),
+		sa.Column('comment', sa.String(200)),
+		sa.Column('order_id', sa.Integer, sa.ForeignKey('archived_orders.id'))
+	)
+	op.create_index('ix_archived_ratings_order_id', 'archived_ratings', ['order_id'])
+
+def downgrade():
+	op.drop_index('ix_archived_ratings_order_id', 'archived_ratings')
+	op.drop_table('archived_ratings')
+	op.drop_index('ix_archived_items_order_id', 'archived_items')
+	op.drop_table('archived_items')
+	op.drop_index('ix_archived_orders_store_created', 'archived_orders')
+	op.drop_index('ix_archived_orders_user_created', 'archived_orders')
+	op.drop_table('archived_orders')
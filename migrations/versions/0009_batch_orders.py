@@ -0,0 +1,32 @@
+"""
+Batch orders, exempt from the one made order per user
+index
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-17 10:00:00
+"""
+
+# Revision identifiers
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+import sqlalchemy as sa
+
+from alembic import op
+
+def upgrade():
+	op.add_column('orders', sa.Column('batch', sa.Boolean, nullable=False, server_default='0'))
+	op.drop_index('uq_orders_user_made', 'orders')
+	op.create_index('uq_orders_user_made', 'orders', ['user_id'], unique=True,
+		postgresql_where=sa.text('status = 0 AND NOT batch'), sqlite_where=sa.text('status = 0 AND NOT batch'))
+
+def downgrade():
+	# Fails while a user has more than one made order, finish or delete them first
+	op.drop_index('uq_orders_user_made', 'orders')
+	op.create_index('uq_orders_user_made', 'orders', ['user_id'], unique=True,
+		postgresql_where=sa.text('status = 0'), sqlite_where=sa.text('status = 0'))
+	with op.batch_alter_table('orders') as batch:
+		batch.drop_column('batch')
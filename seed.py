@@ -0,0 +1,120 @@
+"""
+Seeding functions shared by the explain.py and bench.py
+scripts, they fill a throwaway database with stores,
+orders, items, offers and ratings around a center and
+mint valid tokens for their users.
+"""
+import jwt
+import random
+import time
+
+from app import decode_secret, grid_cell, insert_returning_ids, load_config, rebuild_store_cells, session
+from app import Item, Offer, Order, Rating, Store, ORDER_ACCEPTED, ORDER_FINISHED, ORDER_MADE
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+CENTER = (4.6097, -74.0817)
+SPREAD = 0.5
+CHUNK_SIZE = 1000
+
+config = load_config()
+
+def token(role, user_id):
+	"""
+	Returns a valid bearer token for the given role
+	and user.
+	"""
+	return jwt.encode({
+		'sub': 'auth0|%s' % user_id,
+		'aud': config['AUTH0_CLIENT_ID'],
+		'exp': int(time.time()) + 3600,
+		'app_metadata': { 'user_role': role }
+	}, decode_secret(config['AUTH0_CLIENT_SECRET']))
+
+def insert(table, rows):
+	"""
+	Inserts the given rows in chunks and returns their ids.
+	"""
+	ids = []
+	for start in range(0, len(rows), CHUNK_SIZE):
+		ids.extend(insert_returning_ids(table, rows[start:start + CHUNK_SIZE]))
+	return ids
+
+def store_row(name, user_id):
+	"""
+	Returns the row of a new store placed at random.
+	"""
+	return {
+		'name': name,
+		'place': name,
+		'stars': 5.0,
+		'rating_count': 0,
+		'rating_sum': 0,
+		'lat': CENTER[0] + random.uniform(-SPREAD, SPREAD),
+		'lon': CENTER[1] + random.uniform(-SPREAD, SPREAD),
+		'rad': 5,
+		'user_id': user_id,
+		'created_at': datetime.now()
+	}
+
+def order_row(user_id, status, store_id=None, created_at=None):
+	"""
+	Returns the row of a new order placed at random.
+	"""
+	lat = CENTER[0] + random.uniform(-SPREAD, SPREAD)
+	lon = CENTER[1] + random.uniform(-SPREAD, SPREAD)
+	lat_cell, lon_cell = grid_cell(lat, lon)
+	return {
+		'place': 'Place of %s' % user_id,
+		'status': status,
+		'price': None if status == ORDER_MADE else '10000',
+		'time': None if status == ORDER_MADE else '30',
+		'lat': lat,
+		'lon': lon,
+		'lat_cell': lat_cell,
+		'lon_cell': lon_cell,
+		'user_id': user_id,
+		'store_id': store_id,
+		'created_at': created_at or datetime.now()
+	}
+
+def seed(stores, users, orders, items=2, offers=3):
+	"""
+	Seeds the database and returns the ids of the stores
+	(with their coverage cells) and of the made orders, one for each user. The rest of
+	the orders are accepted or finished orders of the same
+	users, every order gets the given number of items and
+	every made order the given number of offers.
+	"""
+	random.seed(0)
+	now = datetime.now()
+	store_ids = insert(Store.__table__, [store_row('Store %d' % i, 'store%d' % i) for i in range(stores)])
+	rebuild_store_cells()
+	rows = []
+	for i in range(orders):
+		status = ORDER_MADE if i < users else random.choice([ORDER_ACCEPTED, ORDER_FINISHED, ORDER_FINISHED])
+		store_id = None if status == ORDER_MADE else random.choice(store_ids)
+		rows.append(order_row('user%d' % (i % users), status, store_id, now - timedelta(minutes=orders - i)))
+	order_ids = insert(Order.__table__, rows)
+	insert(Item.__table__, [{
+		'amount': 1,
+		'name': 'Item %d' % n,
+		'order_id': order_id
+	} for order_id in order_ids for n in range(items)])
+	made_ids = [order_id for order_id, row in zip(order_ids, rows) if row['status'] == ORDER_MADE]
+	insert(Offer.__table__, [{
+		'price': Decimal('10000'),
+		'time': timedelta(minutes=30),
+		'order_id': order_id,
+		'store_id': store_id
+	} for order_id in made_ids for store_id in random.sample(store_ids, min(offers, len(store_ids)))])
+	session.execute(Order.__table__.update().where(Order.status == ORDER_MADE).values(offer_count=min(offers, len(store_ids))))
+	insert(Rating.__table__, [{
+		'stars': random.randint(1, 10),
+		'comment': 'Comment',
+		'order_id': order_id
+	} for order_id, row in zip(order_ids, rows) if row['status'] == ORDER_FINISHED])
+	session.commit()
+	session.execute('ANALYZE')
+	session.commit()
+	return store_ids, made_ids
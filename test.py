@@ -108,7 +108,7 @@ print 'POST /api/v1.0/offer'
 url = BASE_URL + '/api/v1.0/offer'
 data = {
 	'price': '10000',
-	'time': '1hora',
+	'time': '60',
 	'order_id': 1,
 	'store_id': 1
 }
@@ -118,6 +118,15 @@ print r.text
 
 print '\n'
 
+print 'GET /api/v1.0/order/<int:order_id>/offers'
+id = 1
+url = BASE_URL + '/api/v1.0/order/%d/offers?sort=-stars' % id
+r = requests.get(url, headers=headers('user'))
+print r.status_code
+print r.text
+
+print '\n'
+
 print 'PUT /api/v1.0/order/<int:order_id>'
 id = 1
 url = BASE_URL + '/api/v1.0/order/%d' % id
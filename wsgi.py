@@ -0,0 +1,13 @@
+"""
+WSGI entry point for multi-process servers, e.g.:
+	$ flask/bin/gunicorn --workers 4 --preload wsgi:application
+Creating the app does not connect to the database, every
+worker opens its own pool on its first request. The workers
+share the order notifications through the sockets of
+EVENT_SOCKET_DIR, so they must all run on the same host.
+"""
+import os
+
+from app import create_app, SocketEventBus
+
+application = create_app({ 'EVENT_BUS': SocketEventBus(os.environ.get('EVENT_SOCKET_DIR', '/tmp/move-api-events')) })